@@ -0,0 +1,704 @@
+from array import array
+from bisect import bisect_right
+from contextlib import ExitStack, nullcontext
+from itertools import islice
+
+import callgraph
+from clean import clean_lines
+from jump_threading import thread_jumps
+from main import ADDRESS_SPACE, INSTRUCTION_WORDS, TEXT_LINE, Data, Instruction, parse_line, render_text, to_u16
+from peephole import PeepholeOptimizer
+from sourcemap import build_source_map
+from unpack_macro import MacroExpander, split_functions
+
+# Source lines compared at once when looking for the unchanged start and end of a text
+DIFF_CHUNK = 256
+
+
+def _dump(lines, fout):
+    """Pass lines through unchanged while writing their code to fout."""
+    for ln, line in lines:
+        fout.write(f"{line}\n")
+        yield ln, line
+
+
+def _calls(lines, names: set):
+    """Pass expanded (line_number, code) pairs through, adding the function of every call to names."""
+    previous = None
+    for ln, line in lines:
+        if previous == 'push pc+' and line.startswith('jmp '):
+            names.add(line[4:])
+        previous = line
+        yield ln, line
+
+
+def _common_start(old: list, new: list, limit: int) -> int:
+    """The number of equal items at the start of old and new, at most limit."""
+    count = 0
+    while count + DIFF_CHUNK <= limit and old[count:count + DIFF_CHUNK] == new[count:count + DIFF_CHUNK]:
+        count += DIFF_CHUNK
+    while count < limit and old[count] == new[count]:
+        count += 1
+    return count
+
+
+def _common_end(old: list, new: list, limit: int) -> int:
+    """The number of equal items at the end of old and new, at most limit."""
+    count = 0
+    old_end, new_end = len(old), len(new)
+    while count + DIFF_CHUNK <= limit \
+            and old[old_end - count - DIFF_CHUNK:old_end - count] == new[new_end - count - DIFF_CHUNK:new_end - count]:
+        count += DIFF_CHUNK
+    while count < limit and old[-1 - count] == new[-1 - count]:
+        count += 1
+    return count
+
+
+class Assembler:
+    """
+    State of one compilation: labels, macro state, the image built so far,
+    pending fixups and diagnostics. Use a new Assembler for every program.
+
+    A relocatable Assembler never patches label references itself: every
+    reference stays in fixups, so its image can later be placed at any address.
+    With optimize, the expanded code goes through the peephole optimizer and
+    the laid out image through jump threading; threading counts its changes.
+    rotate_loops selects the loop layout of the macro expander, tail_calls
+    turns a call followed by 'ret rv' into a jump, omit_frame_pointer leaves
+    the bp frame out of functions that do not need it.
+    Calls of 'inline def' functions are replaced by their bodies; with
+    inline_threshold, so are calls without arguments of every function of
+    at most that many lines that does not need a frame of its own.
+    With drop_unused, functions that neither the top-level code nor the
+    names in keep reach through calls and jumps are left out; dropped maps
+    their names to the instructions they would have taken.
+    With a profiling.Profiler, every stage runs to completion on its own and
+    is measured. incbin paths are relative to include_dir.
+    A build with a cache.BuildCache leaves its blocks and its label operands
+    in the cache, so the next build of the same cache only assembles the
+    blocks that changed, see rebuild.
+    """
+
+    def __init__(self, relocatable: bool = False, optimize: bool = False, rotate_loops: bool = True,
+                 tail_calls: bool = True, omit_frame_pointer: bool = True, drop_unused: bool = False, keep=(),
+                 profiler=None, include_dir: str = '', inline_threshold: int = 0):
+        self.relocatable = relocatable
+        self.optimize = optimize
+        self.rotate_loops = rotate_loops
+        self.tail_calls = tail_calls
+        self.omit_frame_pointer = omit_frame_pointer
+        self.drop_unused = drop_unused
+        self.keep = tuple(keep)
+        self.profiler = profiler
+        self.include_dir = include_dir
+        self.inline_threshold = inline_threshold
+        self.dropped = {}
+        self.peephole = PeepholeOptimizer() if optimize else None
+        self.labels = {}
+        self.command_line = 0
+        self.messages = []
+        self.expander = MacroExpander(rotate_loops, tail_calls, omit_frame_pointer)
+        self.image = array('H')
+        self.fixups = []
+        # (instruction index, field) of every label operand, patched or not
+        self.references = []
+        # Source line number of every instruction
+        self.lines = array('I')
+        # (first slot, slots) of every data directive
+        self.data = []
+        self.threading = None
+        # Encoded instructions by line text, taken from the build cache
+        self.encoded = None
+        # The inline functions as part of the cache key of functions that may call them
+        self.inline_key = ''
+        # Keep every label operand as a fixup, so that a later build can patch it again
+        self.deferred = False
+        # The build left for the next one in the cache, see rebuild
+        self.snapshot = None
+        # Blocks assembled again by rebuild, None after a full build
+        self.changed_blocks = None
+
+    def stage(self, name: str, stream):
+        """Measure a stream stage with the profiler, if there is one."""
+        return stream if self.profiler is None else self.profiler.stage(name, stream)
+
+    def measure(self, name: str):
+        return nullcontext({}) if self.profiler is None else self.profiler.measure(name)
+
+    @property
+    def error_counter(self) -> int:
+        return len(self.messages)
+
+    def error(self, message: str):
+        self.messages.append(message)
+
+    def base_assemble_lines(self, lines):
+        """
+        Encode (line_number, code) pairs of base instructions and data directives.
+        Yields (line_number, Instruction | Data) pairs with label operands left as fixups.
+        Data is never kept in encoded: an incbin file may change between builds.
+        """
+        encoded = self.encoded
+        for ln, line in lines:
+            parsed = encoded.get(line) if encoded is not None else None
+            if parsed is not None:
+                self.command_line += 1
+                yield ln, parsed
+                continue
+            try:
+                parsed = parse_line(line, self.labels, self.command_line, self.include_dir)
+                if parsed:
+                    self.command_line += parsed.slots
+                    if encoded is not None and type(parsed) is Instruction:
+                        encoded[line] = parsed
+                    yield ln, parsed
+
+            except ValueError as e:
+                self.error(f"Error while assemble: {ln}: {e}")
+                continue
+
+    def emit_instructions(self, instructions):
+        """
+        Append (line_number, Instruction | Data) pairs to the image in a single pass.
+        Labels defined earlier are patched in place. Forward references are kept
+        as (instruction index, field, label, line) fixups for patch_fixups.
+        """
+        labels = self.labels
+        image = self.image
+        fixups = self.fixups
+        references = self.references
+        source_lines = self.lines
+        relocatable = self.relocatable or self.deferred
+        index = len(image) // INSTRUCTION_WORDS
+        for ln, instruction in instructions:
+            if type(instruction) is Data:
+                self.emit_data(ln, instruction)
+                index += instruction.slots
+                continue
+            image.extend(instruction.words())
+            source_lines.append(ln)
+            if instruction.fixup is not None:
+                field, key = instruction.fixup
+                references.append((index, field))
+                address = None if relocatable else labels.get(key)
+                if address is None:
+                    fixups.append((index, field, key, ln))
+                else:
+                    image[index * INSTRUCTION_WORDS + field] = to_u16(address)
+            index += 1
+
+    def emit_data(self, ln: int, data: Data):
+        """Append the words of a data directive; its label values become references like label operands."""
+        index = len(self.image) // INSTRUCTION_WORDS
+        self.image.extend(data.words())
+        self.lines.extend([ln] * data.slots)
+        if data.slots:
+            self.data.append((index, data.slots))
+        for offset, key in data.fixups:
+            slot, field = divmod(offset, INSTRUCTION_WORDS)
+            self.references.append((index + slot, field))
+            address = None if self.relocatable or self.deferred else self.labels.get(key)
+            if address is None:
+                self.fixups.append((index + slot, field, key, ln))
+            else:
+                self.image[(index + slot) * INSTRUCTION_WORDS + field] = to_u16(address)
+
+    def patch_fixups(self):
+        labels = self.labels
+        image = self.image
+        for index, field, key, ln in self.fixups:
+            address = labels.get(key)
+            if address is None:
+                self.error(f"Error while assemble: {ln}: label '{key}' is not defined")
+                continue
+            image[index * INSTRUCTION_WORDS + field] = to_u16(address)
+        self.fixups = []
+
+    def assemble_instructions(self, instructions) -> array:
+        self.emit_instructions(instructions)
+        self.patch_fixups()
+        return self.image
+
+    def fragment(self, first_line: int) -> dict:
+        """
+        Export the state of a relocatable Assembler: words, labels as offsets,
+        data ranges, and fixups, instruction lines and macros with line numbers
+        relative to first_line.
+        """
+        return {
+            'words': self.image,
+            'labels': self.labels,
+            'fixups': [(index, field, key, ln - first_line) for index, field, key, ln in self.fixups],
+            'lines': [ln - first_line for ln in self.lines],
+            'data': self.data,
+            'macros': [(ln - first_line, kind, label) for ln, (kind, label) in self.expander.macros.items()],
+            'inlined': self.expander.inlined,
+        }
+
+    def add_fragment(self, fragment: dict, first_line: int):
+        """Place a fragment at the current address and merge its labels and fixups."""
+        base = len(self.image) // INSTRUCTION_WORDS
+        for label, offset in fragment['labels'].items():
+            if label in self.labels:
+                # A label is on the line of the instruction it names, the def for the function itself
+                lines = fragment['lines']
+                ln = first_line + (lines[offset] if 0 < offset < len(lines) else 0)
+                self.error(f"Error while assemble: {ln}: Label {label} already in labels. Each label should appear once.")
+                continue
+            self.labels[label] = base + offset
+        self.image.extend(fragment['words'])
+        self.lines.extend(first_line + ln for ln in fragment['lines'])
+        self.data.extend((base + start, slots) for start, slots in fragment['data'])
+        self.expander.macros.update((first_line + ln, (kind, label)) for ln, kind, label in fragment['macros'])
+        self.expander.summaries.update(fragment['summaries'])
+        for name, (calls, removed) in fragment['inlined'].items():
+            stats = self.expander.inlined.setdefault(name, [0, 0])
+            stats[0] += calls
+            stats[1] += removed
+        self.fixups.extend(
+            (base + index, field, key, first_line + ln) for index, field, key, ln in fragment['fixups']
+        )
+        self.references.extend((base + index, field) for index, field, _, _ in fragment['fixups'])
+        self.command_line = len(self.image) // INSTRUCTION_WORDS
+
+    def render_text(self) -> str:
+        """
+        The image in the text format. The lines stay in the snapshot, so
+        after a rebuild only the changed instructions are rendered again.
+        """
+        snapshot = self.snapshot
+        if snapshot is None or snapshot['image'] is not self.image:
+            return render_text(self.image)
+        if snapshot['rendered'] is None:
+            snapshot['rendered'] = render_text(self.image).splitlines(True)
+        return ''.join(snapshot['rendered'])
+
+    def source_map(self, file: str = '') -> dict:
+        """The source map of the assembled image, see sourcemap.build_source_map."""
+        return build_source_map(self.lines, self.expander.macros, self.labels, file, self.data)
+
+    def options(self) -> str:
+        """Options that change the code of a function, part of its cache key."""
+        return (f"optimize={self.optimize} rotate_loops={self.rotate_loops} tail_calls={self.tail_calls} "
+                f"omit_frame_pointer={self.omit_frame_pointer} inline_threshold={self.inline_threshold}"
+                + self.inline_key)
+
+    def build_function(self, function: str, lines: list, cache) -> tuple[str, dict | None]:
+        """
+        Expand and encode one def ... ret block on its own, reusing the cached
+        fragment when the block is unchanged. Returns the cache key and the
+        fragment, which is None if the block has errors; they are reported
+        when the block is assembled in place.
+        Automatic saves and the summary of the block depend on what the callees
+        read, so a cached fragment is only taken while the summaries of the
+        functions it calls are the ones it was built with.
+        """
+        summaries = self.expander.summaries
+        # Fragment lines are relative to the def, so the key covers where every line is
+        first_line = lines[0][0]
+        key = cache.key((f"{ln - first_line} {line}" for ln, line in lines), self.options())
+        fragment = cache.get(key, lambda cached: all(
+            summaries.get(name) == summary for name, summary in cached['callees'].items()))
+        if fragment is not None:
+            return key, fragment
+
+        sub = Assembler(relocatable=True, optimize=self.optimize, rotate_loops=self.rotate_loops,
+                        tail_calls=self.tail_calls, omit_frame_pointer=self.omit_frame_pointer,
+                        include_dir=self.include_dir, inline_threshold=self.inline_threshold)
+        sub.peephole = self.peephole
+        sub.encoded = self.encoded
+        sub.expander.inline = self.expander.inline
+        sub.expander.summaries = dict(summaries)
+        callees = set()
+        stream = _calls(sub.expander.unpack_macro_lines(lines, sub.messages), callees)
+        if sub.peephole is not None:
+            stream = sub.peephole.optimize(stream)
+        sub.emit_instructions(sub.base_assemble_lines(stream))
+        if sub.messages:
+            return key, None
+        fragment = sub.fragment(lines[0][0])
+        fragment['summaries'] = {function: sub.expander.summaries[function]}
+        fragment['callees'] = {name: summaries.get(name) for name in sorted(callees)}
+        cache.put(key, fragment)
+        return key, fragment
+
+    def drop_functions(self, blocks: list) -> list:
+        """Remove unreachable function blocks and record their expanded size in dropped."""
+        kept, dropped = callgraph.drop_unused(blocks, self.keep)
+        for function, lines in dropped:
+            expander = MacroExpander(self.rotate_loops, self.tail_calls, self.omit_frame_pointer)
+            expander.inline = self.expander.inline
+            expanded = expander.unpack_macro_lines(lines, [])
+            self.dropped[function] = sum(1 for _, line in expanded if not line.startswith("label "))
+        return kept
+
+    def drop_report(self) -> str:
+        instructions = sum(self.dropped.values())
+        return (f"dropped {len(self.dropped)} unused functions, {instructions} instructions, "
+                f"{instructions * INSTRUCTION_WORDS * 2} bytes"
+                + ''.join(f"\n    {name}: {count}" for name, count in self.dropped.items()))
+
+    def inline_report(self) -> str:
+        calls = sum(calls for calls, _ in self.expander.inlined.values())
+        removed = sum(removed for _, removed in self.expander.inlined.values())
+        return (f"inlined {calls} calls of {len(self.expander.inlined)} functions, "
+                f"{removed} instructions of call overhead removed"
+                + ''.join(f"\n    {name}: {calls} calls, {removed} instructions"
+                          for name, (calls, removed) in self.expander.inlined.items()))
+
+    def build(self, source, dumps: dict | None = None, cache=None):
+        """
+        Run the pipeline up to the image and the pending fixups, without patching them.
+        source is any iterable of text lines (an open file, a list of strings).
+        dumps optionally maps 'clean', 'macro' and 'labels' to paths where the
+        intermediate stage is written for debugging.
+        With a cache.BuildCache, unchanged functions are taken from the cache
+        and only the layout and the fixups are redone, and lines it has already
+        encoded are not parsed again; the 'macro' and 'labels'
+        dumps then only cover the code outside cached functions.
+        With drop_unused, unreachable functions are removed right after cleaning.
+        Inline functions are collected from the whole cleaned source first,
+        so a call may come before the definition it expands.
+        Without dumps, a profiler, drop_unused and inline_threshold, a build
+        with a cache first tries to rebuild the previous one.
+        """
+        settings = (self.options(), self.include_dir)
+        recording = cache is not None and not dumps and self.profiler is None and not self.relocatable \
+            and not self.drop_unused and not self.inline_threshold
+        if recording:
+            source = list(source)
+            previous = cache.previous
+            if previous is not None and previous['settings'] == settings:
+                if self.rebuild(source, previous, cache):
+                    self.check_size()
+                    return
+                # A failed rebuild leaves its summaries and inline functions behind
+                self.expander = MacroExpander(self.rotate_loops, self.tail_calls, self.omit_frame_pointer)
+                self.inline_key = ''
+            self.deferred = True
+        records = []
+
+        with ExitStack() as stack:
+            files = {
+                stage: stack.enter_context(open(path, 'w', encoding='utf-8'))
+                for stage, path in (dumps or {}).items()
+            }
+
+            if cache is not None:
+                self.encoded = cache.instructions
+            stream = self.stage('clean', clean_lines(source))
+            if 'clean' in files:
+                stream = _dump(stream, files['clean'])
+            stream = list(stream)
+            self.expander.collect_inline(stream, self.messages, self.inline_threshold)
+            if self.expander.inline:
+                self.inline_key = " inline=" + repr(sorted(
+                    (name, function['params'], function['saves'], function['body'], function['value'], function['auto'])
+                    for name, function in self.expander.inline.items()))
+
+            if cache is None and not self.drop_unused:
+                blocks = [(None, stream)]
+            else:
+                blocks = split_functions(stream)
+                if self.drop_unused:
+                    with self.measure('drop') as record:
+                        blocks = self.drop_functions(blocks)
+                        record['items'] = len(self.dropped)
+
+            for function, lines in blocks:
+                if recording:
+                    records.append(self.block_record(function, 0 if not records else lines[0][0] - 1))
+                # The cache key does not cover the contents of incbin files
+                if cache is not None and function is not None and self.expander.nests.empty() \
+                        and not self.expander.global_function['is_inside'] \
+                        and not any(line.startswith('incbin') for _, line in lines):
+                    with self.measure('cache') as record:
+                        key, fragment = self.build_function(function, lines, cache)
+                        record['items'] = 0 if fragment is None else len(fragment['lines'])
+                    if fragment is not None:
+                        if recording:
+                            records[-1].update(key=key, fragment=fragment, callees=fragment['callees'])
+                        self.add_fragment(fragment, lines[0][0])
+                        continue
+
+                stream = self.stage('macro', self.expander.unpack_macro_lines(lines, self.messages, finish=False))
+                if recording:
+                    stream = _calls(stream, records[-1]['callees'])
+                if self.peephole is not None:
+                    stream = self.stage('peephole', self.peephole.optimize(stream))
+                if 'macro' in files:
+                    stream = _dump(stream, files['macro'])
+                stream = self.stage('parse', self.base_assemble_lines(stream))
+                if 'labels' in files:
+                    stream = _dump(stream, files['labels'])
+                with self.measure('emit') as record:
+                    start = len(self.lines)
+                    self.emit_instructions(stream)
+                    record['items'] = len(self.lines) - start
+
+        self.expander.check_finished(self.messages)
+        self.check_size()
+        if recording:
+            records.append(self.block_record(None, len(source)))
+            self.snapshot = self.make_snapshot(settings, source, records, self.fixups, None)
+
+    def check_size(self):
+        size = len(self.image) // INSTRUCTION_WORDS
+        if size > ADDRESS_SPACE and not self.relocatable:
+            self.error(f"Error while assemble: {size} instructions do not fit in {ADDRESS_SPACE} addresses")
+
+    def block_record(self, function: str | None, start: int) -> dict:
+        """
+        A block of the snapshot: its function, its first source line counted
+        from 0, where its instructions and its entries of the labels, label
+        operands, macros, data ranges and summaries begin, and the functions
+        it calls. A block taken from the cache gets its key and fragment as well.
+        """
+        return {
+            'function': function,
+            'start': start,
+            'base': len(self.image) // INSTRUCTION_WORDS,
+            'labels': len(self.labels),
+            'links': len(self.fixups),
+            'macros': len(self.expander.macros),
+            'data': len(self.data),
+            'known': len(self.expander.summaries),
+            'callees': set(),
+            'key': None,
+            'fragment': None,
+        }
+
+    def make_snapshot(self, settings: tuple, text: list, blocks: list, links: list, rendered) -> dict:
+        """
+        The state rebuild starts from: the source text, its blocks, the last
+        of which only marks the end, every label operand as a fixup, and the
+        patched image with everything that goes with it. Shares the containers
+        of the Assembler, which are not changed after the build. rendered is
+        the list of text lines of the image, or None until render_text needs it.
+        """
+        return {
+            'settings': settings,
+            'text': text,
+            'starts': [block['start'] for block in blocks],
+            'blocks': blocks,
+            'links': links,
+            'image': self.image,
+            'labels': self.labels,
+            'lines': self.lines,
+            'data': self.data,
+            'macros': self.expander.macros,
+            'summaries': self.expander.summaries,
+            'inlined': self.expander.inlined,
+            'inline': self.expander.inline,
+            'inline_key': self.inline_key,
+            'rendered': rendered,
+        }
+
+    def rebuild(self, text: list, previous: dict, cache) -> bool:
+        """
+        Build text by changing the previous snapshot instead of starting over.
+        Lines equal at the start and at the end of both texts are unchanged;
+        the blocks the rest falls in are split again and built through the
+        cache, the blocks after them move with their words, and only label
+        operands whose targets moved are patched again.
+        Works when every changed block is a function taken from the cache and
+        the new ones are too, and no later block calls a function whose summary
+        changed. Otherwise returns False, and the Assembler needs a new
+        expander for a full build.
+        """
+        old_text = previous['text']
+        blocks = previous['blocks']
+        starts = previous['starts']
+        # The last block only marks the end
+        count = len(blocks) - 1
+        if not count:
+            return False
+        head = _common_start(old_text, text, min(len(old_text), len(text)))
+        tail = _common_end(old_text, text, min(len(old_text), len(text)) - head)
+        delta = len(text) - len(old_text)
+        changed = len(old_text) - tail
+        if head == changed == len(text):
+            first = last = count
+        elif head == changed:
+            # Inserted lines go to the block they are inserted into
+            first = min(bisect_right(starts, head), count) - 1
+            last = first + 1
+        else:
+            first = bisect_right(starts, head) - 1
+            last = bisect_right(starts, changed - 1)
+        old = blocks[first:last]
+        if any(block['fragment'] is None for block in old):
+            return False
+        start, end = starts[first], starts[last]
+        region = split_functions(clean_lines(text[start:end + delta], start + 1))
+        if any(function is None for function, _ in region) or (old and not region):
+            return False
+
+        summaries = list(previous['summaries'].items())
+        self.expander.inline = previous['inline']
+        self.inline_key = previous['inline_key']
+        self.expander.summaries = dict(summaries[:blocks[first]['known']])
+        fresh = []
+        for function, lines in region:
+            if any(line.startswith(('incbin', 'inline')) for _, line in lines):
+                return False
+            known = len(self.expander.summaries)
+            key, fragment = self.build_function(function, lines, cache)
+            if fragment is None:
+                return False
+            self.expander.summaries.update(fragment['summaries'])
+            fresh.append((known, key, fragment))
+        replaced = dict(summaries[blocks[first]['known']:blocks[last]['known']])
+        rebuilt = {name: summary for _, _, fragment in fresh for name, summary in fragment['summaries'].items()}
+        # Later blocks read the summaries of the functions they call
+        moved_summaries = {name for name in replaced.keys() | rebuilt.keys() if replaced.get(name) != rebuilt.get(name)}
+        if moved_summaries and any(not moved_summaries.isdisjoint(block['callees']) for block in blocks[last:]):
+            return False
+
+        old_labels = previous['labels']
+        old_names = set()
+        for block in old:
+            old_names.update(block['fragment']['labels'])
+        old_macros = previous['macros']
+        head_block, tail_block = blocks[first], blocks[last]
+        a, b = head_block['base'], tail_block['base']
+        image = previous['image'][:a * INSTRUCTION_WORDS]
+        labels = dict(islice(old_labels.items(), head_block['labels']))
+        lines = previous['lines'][:a]
+        links = previous['links'][:head_block['links']]
+        macros = dict(islice(old_macros.items(), head_block['macros']))
+        data = previous['data'][:head_block['data']]
+        records = blocks[:first]
+
+        base = a
+        for (function, block_lines), (known, key, fragment) in zip(region, fresh):
+            first_line = block_lines[0][0]
+            records.append({
+                'function': function,
+                'start': start if len(records) == first else first_line - 1,
+                'base': base,
+                'labels': len(labels),
+                'links': len(links),
+                'macros': len(macros),
+                'data': len(data),
+                'known': known,
+                'callees': fragment['callees'],
+                'key': key,
+                'fragment': fragment,
+            })
+            for label, offset in fragment['labels'].items():
+                # A full build reports the duplicate
+                if label in labels or (label in old_labels and label not in old_names):
+                    return False
+                labels[label] = base + offset
+            image.extend(fragment['words'])
+            lines.extend([first_line + ln for ln in fragment['lines']])
+            data.extend((base + data_start, slots) for data_start, slots in fragment['data'])
+            macros.update((first_line + ln, (kind, label)) for ln, kind, label in fragment['macros'])
+            links.extend((base + index, field, label, first_line + ln)
+                         for index, field, label, ln in fragment['fixups'])
+            base += len(fragment['words']) // INSTRUCTION_WORDS
+        region_links = len(links) - head_block['links']
+
+        shift = base - b
+        moved_labels = len(labels) - tail_block['labels']
+        moved_links = len(links) - tail_block['links']
+        moved_macros = len(macros) - tail_block['macros']
+        moved_data = len(data) - tail_block['data']
+        moved_known = len(rebuilt) - len(replaced)
+        records.extend([dict(block, start=block['start'] + delta, base=block['base'] + shift,
+                             labels=block['labels'] + moved_labels, links=block['links'] + moved_links,
+                             macros=block['macros'] + moved_macros, data=block['data'] + moved_data,
+                             known=block['known'] + moved_known) for block in blocks[last:]])
+        image += previous['image'][b * INSTRUCTION_WORDS:]
+        tail_labels = list(islice(old_labels.items(), tail_block['labels'], None))
+        for label, address in tail_labels:
+            labels[label] = address + shift
+        if delta:
+            lines.extend([ln + delta for ln in previous['lines'][b:]])
+        else:
+            lines += previous['lines'][b:]
+        if shift or delta:
+            links.extend([(index + shift, field, label, ln + delta)
+                          for index, field, label, ln in previous['links'][tail_block['links']:]])
+        else:
+            links += previous['links'][tail_block['links']:]
+        for ln, macro in islice(old_macros.items(), tail_block['macros'], None):
+            macros[ln + delta] = macro
+        data.extend((data_start + shift, slots) for data_start, slots in previous['data'][tail_block['data']:])
+
+        # Operands of the new blocks, then every operand whose label moved or is gone
+        targets = set(old_names)
+        if shift:
+            targets.update(label for label, _ in tail_labels)
+        targets = {label for label in targets if labels.get(label) != old_labels.get(label)}
+        for index, field, label, _ in links[head_block['links']:head_block['links'] + region_links]:
+            address = labels.get(label)
+            if address is None:
+                return False
+            image[index * INSTRUCTION_WORDS + field] = to_u16(address)
+        patched = set()
+        if targets:
+            for index, field, label, _ in links:
+                if label in targets:
+                    address = labels.get(label)
+                    if address is None:
+                        return False
+                    image[index * INSTRUCTION_WORDS + field] = to_u16(address)
+                    patched.add(index)
+
+        rendered = previous['rendered']
+        if rendered is not None:
+            rendered = rendered[:a] + [
+                TEXT_LINE % tuple(image[index * INSTRUCTION_WORDS:(index + 1) * INSTRUCTION_WORDS])
+                for index in range(a, base)
+            ] + rendered[b:]
+            for index in patched:
+                rendered[index] = TEXT_LINE % tuple(image[index * INSTRUCTION_WORDS:(index + 1) * INSTRUCTION_WORDS])
+
+        inlined = {name: list(stats) for name, stats in previous['inlined'].items()}
+        for block in old:
+            for name, (calls, removed) in block['fragment']['inlined'].items():
+                inlined[name][0] -= calls
+                inlined[name][1] -= removed
+        for _, _, fragment in fresh:
+            for name, (calls, removed) in fragment['inlined'].items():
+                stats = inlined.setdefault(name, [0, 0])
+                stats[0] += calls
+                stats[1] += removed
+
+        self.image, self.labels, self.lines, self.data = image, labels, lines, data
+        # Only jump threading reads the references
+        if self.optimize:
+            self.references = [(index, field) for index, field, _, _ in links]
+        self.command_line = len(image) // INSTRUCTION_WORDS
+        self.expander.macros = macros
+        self.expander.summaries = dict(summaries[:head_block['known']] + list(rebuilt.items())
+                                       + summaries[tail_block['known']:])
+        self.expander.inlined = {name: stats for name, stats in inlined.items() if stats != [0, 0]}
+        self.changed_blocks = len(fresh)
+        # Unchanged functions count as taken from the cache and stay in its memory
+        cache.hits += sum(1 for block in records if block['fragment'] is not None) - len(fresh)
+        cache.used.update(block['key'] for block in records if block['key'] is not None)
+        self.snapshot = self.make_snapshot(previous['settings'], text, records, links, rendered)
+        return True
+
+    def assemble(self, source, dumps: dict | None = None, cache=None) -> array:
+        """Run the whole pipeline in memory and return the image as u16 words. See build."""
+        self.build(source, dumps, cache)
+        with self.measure('patch') as record:
+            record['items'] = len(self.fixups)
+            self.patch_fixups()
+        if cache is not None and not self.relocatable:
+            cache.previous = None if self.messages else self.snapshot
+        if self.optimize and not self.messages:
+            with self.measure('threading') as record:
+                self.image, self.labels, self.lines, self.data, self.threading = thread_jumps(
+                    self.image, self.labels, self.references, self.lines, self.data)
+                record['items'] = len(self.lines)
+        return self.image
+
+
+def assemble(source, dumps: dict | None = None, cache=None, **options) -> array:
+    """Assemble source with a fresh Assembler built with options and return the image."""
+    return Assembler(**options).assemble(source, dumps, cache)
@@ -0,0 +1,184 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from assemble import Assembler
+from cache import BuildCache
+from image import write_image
+from main import INSTRUCTION_WORDS
+from profiling import Profiler, format_report
+from sourcemap import write_source_map
+
+
+def expand_sources(patterns: list[str]) -> list[str]:
+    """Expand glob patterns into a sorted list of files without duplicates."""
+    sources = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        if not matches and os.path.isfile(pattern):
+            matches = [pattern]
+        sources.update(matches)
+    return sorted(sources)
+
+
+def output_path(source: str, out_dir: str | None, output_format: str) -> str:
+    stem = os.path.splitext(os.path.basename(source))[0]
+    directory = out_dir if out_dir is not None else os.path.dirname(source)
+    extension = '.bin' if output_format == 'bin' else '.out.txt'
+    return os.path.join(directory, stem + extension)
+
+
+def build_one(source: str, out_dir: str | None = None, output_format: str = 'text',
+              cache_dir: str | None = None, options: dict | None = None, source_map: bool = False,
+              profile: bool = False, cache: BuildCache | None = None) -> dict:
+    """
+    Assemble one file and write its output, and its source map with source_map.
+    With profile, result['profile'] holds the per-stage report. Runs inside a
+    worker process; a caller that keeps a BuildCache between builds passes it as cache.
+    """
+    result = {
+        'source': source,
+        'output': None,
+        'instructions': 0,
+        'removed': {},
+        'dropped': {},
+        'inlined': {},
+        'threaded': 0,
+        'profile': None,
+        'errors': [],
+    }
+    profiler = Profiler() if profile else None
+    assembler = Assembler(**(options or {}), profiler=profiler, include_dir=os.path.dirname(source))
+    if cache is None and cache_dir is not None:
+        cache = BuildCache(cache_dir)
+    try:
+        with open(source, 'r', encoding='utf-8') as fin:
+            image = assembler.assemble(fin, cache=cache)
+    except (OSError, KeyError, ValueError) as e:
+        result['errors'].append(f"{type(e).__name__}: {e}")
+        return result
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            result['profile'] = profiler.report(source=source, instructions=len(assembler.lines))
+
+    result['errors'].extend(assembler.messages)
+    result['instructions'] = len(image) // INSTRUCTION_WORDS
+    if assembler.peephole is not None:
+        result['removed'] = assembler.peephole.removed
+    result['dropped'] = assembler.dropped
+    result['inlined'] = assembler.expander.inlined
+    if assembler.threading is not None:
+        result['threaded'] = assembler.threading['removed']
+    if result['errors']:
+        return result
+
+    path = output_path(source, out_dir, output_format)
+    if output_format == 'bin':
+        write_image(path, image, header=True, labels=assembler.labels)
+    else:
+        with open(path, 'w', encoding='utf-8') as fout:
+            fout.write(assembler.render_text())
+    if source_map:
+        write_source_map(path + '.map.json', assembler.source_map(source))
+    result['output'] = path
+    return result
+
+
+def build_batch(sources: list[str], out_dir: str | None = None, output_format: str = 'text',
+                jobs: int | None = None, cache_dir: str | None = None, options: dict | None = None,
+                source_map: bool = False, profile: bool = False) -> list[dict]:
+    """
+    Assemble every source in a process pool. options are passed to every
+    Assembler. Results keep the order of sources.
+    """
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    n = len(sources)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(build_one, sources, [out_dir] * n, [output_format] * n,
+                                 [cache_dir] * n, [options] * n, [source_map] * n, [profile] * n))
+
+
+def add_build_options(parser: argparse.ArgumentParser):
+    """Command line flags for the Assembler options, read back with build_options."""
+    parser.add_argument('-O', '--optimize', action='store_true', help="run the peephole optimizer")
+    parser.add_argument('--no-rotate-loops', dest='rotate_loops', action='store_false',
+                        help="keep the for/while test at the top of the loop")
+    parser.add_argument('--no-tail-calls', dest='tail_calls', action='store_false',
+                        help="keep a call followed by 'ret rv' as a call")
+    parser.add_argument('--keep-frame-pointer', dest='omit_frame_pointer', action='store_false',
+                        help="set up bp in every function, even where nothing uses it")
+    parser.add_argument('--drop-unused', action='store_true',
+                        help="leave out functions the top-level code never reaches")
+    parser.add_argument('--keep', action='append', default=[], metavar='NAME',
+                        help="function or label to keep with --drop-unused, may be repeated")
+    parser.add_argument('--inline-threshold', type=int, default=0, metavar='N',
+                        help="also inline calls without arguments of functions of at most N lines")
+
+
+def build_options(args: argparse.Namespace) -> dict:
+    return {
+        'optimize': args.optimize,
+        'rotate_loops': args.rotate_loops,
+        'tail_calls': args.tail_calls,
+        'omit_frame_pointer': args.omit_frame_pointer,
+        'drop_unused': args.drop_unused,
+        'keep': args.keep,
+        'inline_threshold': args.inline_threshold,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Assemble many programs in parallel.")
+    parser.add_argument('sources', nargs='+', help="source files or glob patterns")
+    parser.add_argument('-o', '--out-dir', help="directory for outputs (default: next to each source)")
+    parser.add_argument('-f', '--format', choices=('text', 'bin'), default='text')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--cache', metavar='DIR', help="reuse unchanged functions from this build cache")
+    parser.add_argument('--source-map', action='store_true', help="write <output>.map.json next to every output")
+    parser.add_argument('--profile', action='store_true',
+                        help="measure time, items and peak memory of every stage (slower)")
+    parser.add_argument('--profile-json', metavar='PATH', help="write the --profile reports of all sources as JSON")
+    add_build_options(parser)
+    args = parser.parse_args(argv)
+
+    sources = expand_sources(args.sources)
+    if not sources:
+        print("No sources found", file=sys.stderr)
+        return 1
+
+    failed = 0
+    options = build_options(args)
+    profile = args.profile or args.profile_json is not None
+    results = build_batch(sources, args.out_dir, args.format, args.jobs, args.cache, options, args.source_map, profile)
+    for result in results:
+        if result['errors']:
+            failed += 1
+            print(f"FAIL {result['source']}")
+            for message in result['errors']:
+                print(f"    {message}")
+        else:
+            removed = sum(result['removed'].values()) + result['threaded']
+            saved = f", {removed} removed by the optimizer" if result['removed'] else ''
+            if result['dropped']:
+                saved += f", {len(result['dropped'])} unused functions dropped"
+            if result['inlined']:
+                saved += f", {sum(calls for calls, _ in result['inlined'].values())} calls inlined"
+            print(f"ok   {result['source']} -> {result['output']} ({result['instructions']} instructions{saved})")
+        if args.profile and result['profile'] is not None:
+            print(format_report(result['profile']))
+
+    if args.profile_json is not None:
+        with open(args.profile_json, 'w', encoding='utf-8') as fout:
+            json.dump([result['profile'] for result in results if result['profile'] is not None], fout, indent=2)
+
+    print(f"{len(sources) - failed}/{len(sources)} built")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
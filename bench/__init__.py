@@ -0,0 +1 @@
+"""Synthetic programs and a harness to time the assembler against a stored baseline."""
@@ -0,0 +1,134 @@
+import argparse
+import random
+import sys
+
+REGISTERS = ['r0', 'r1', 'r2']
+CALCS = ['add', 'sub', 'and', 'or', 'xor', 'mul', 'shl', 'shr']
+CONDITIONS = ['eq', 'lt', 'lte', 'gt', 'gte', 'lts', 'gtes']
+
+# Source lines of one generated function body, about
+FUNCTION_LINES = 40
+
+
+class Generator:
+    """
+    Builds a program of about the requested number of lines: top-level code
+    calling every function, then the functions, each with save, reserve and
+    args, nested if/elif/else blocks, for and while loops, and labels with
+    jumps to them. Programs assemble without errors; they are not meant to run.
+    """
+
+    def __init__(self, seed: int = 0, depth: int = 4):
+        self.rng = random.Random(seed)
+        self.depth = depth
+        self.out = []
+        self.labels = 0
+
+    def operand(self) -> str:
+        if self.rng.random() < 0.5:
+            return self.rng.choice(REGISTERS)
+        return str(self.rng.randrange(0, 1000))
+
+    def statement(self):
+        rng = self.rng
+        register = rng.choice(REGISTERS)
+        if rng.random() < 0.2:
+            self.out.append(f"mov {self.operand()} {register}")
+        else:
+            self.out.append(f"{rng.choice(CALCS)} {register} {self.operand()} {register}")
+        if rng.random() < 0.1:
+            self.out.append(f"    ; {rng.randrange(1 << 30):x}")
+
+    def condition(self) -> str:
+        return f"{self.rng.choice(CONDITIONS)} {self.rng.choice(REGISTERS)} {self.operand()}"
+
+    def block(self, budget: int, depth: int):
+        end = len(self.out) + budget
+        while len(self.out) < end:
+            choice = self.rng.random()
+            remaining = end - len(self.out)
+            if depth and remaining > 8 and choice < 0.15:
+                self.out.append(f"if {self.condition()}")
+                self.block(remaining // 4, depth - 1)
+                for _ in range(self.rng.randrange(3)):
+                    self.out.append(f"elif {self.condition()}")
+                    self.block(remaining // 8, depth - 1)
+                if self.rng.random() < 0.5:
+                    self.out.append("else")
+                    self.block(remaining // 8, depth - 1)
+                self.out.append("end")
+            elif depth and remaining > 6 and choice < 0.25:
+                step = self.rng.choice(['', ' 2'])
+                self.out.append(f"for r{self.rng.randrange(3, 6)} 0 {self.rng.randrange(2, 100)}{step}")
+                self.block(remaining // 4, depth - 1)
+                self.out.append("end")
+            elif depth and remaining > 6 and choice < 0.3:
+                register = self.rng.choice(REGISTERS)
+                self.out.append(f"while lt {register} {self.rng.randrange(10, 1000)}")
+                self.block(remaining // 4, depth - 1)
+                self.out.append(f"add {register} 1 {register}")
+                self.out.append("end")
+            elif choice < 0.35:
+                label = f"bench_{self.labels}"
+                self.labels += 1
+                self.out.append(f"jmp {label}")
+                self.statement()
+                self.out.append(f"label {label}")
+            else:
+                self.statement()
+
+    def function(self, index: int, functions: int):
+        rng = self.rng
+        args = rng.randrange(3)
+        header = f"def f{index} save r3 r4"
+        if rng.random() < 0.5:
+            header += f" reserve {rng.randrange(1, 4)}"
+        if args:
+            header += f" args {args}"
+        self.out.append(header)
+        self.block(FUNCTION_LINES // 2, self.depth)
+        # Call later functions only, so the call graph has no cycles
+        if index + 1 < functions and rng.random() < 0.5:
+            self.call(rng.randrange(index + 1, functions))
+        self.block(FUNCTION_LINES // 4, self.depth)
+        self.out.append(f"ret {rng.choice(REGISTERS + ['rv'])}")
+
+    def call(self, index: int):
+        args = ' '.join(self.operand() for _ in range(self.rng.randrange(3)))
+        line = f"call f{index} save r0 r1"
+        if args:
+            line += f" args {args}"
+        self.out.append(line)
+
+    def program(self, lines: int) -> list[str]:
+        functions = max(1, lines // (FUNCTION_LINES + 10))
+        for index in range(functions):
+            self.call(index)
+            self.block(5, self.depth)
+        self.out.append("exit")
+        for index in range(functions):
+            self.function(index, functions)
+        return self.out
+
+
+def generate(lines: int, seed: int = 0, depth: int = 4) -> list[str]:
+    """A synthetic program of about lines source lines, the same for the same seed."""
+    return Generator(seed, depth).program(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Write a synthetic program for benchmarks.")
+    parser.add_argument('output')
+    parser.add_argument('-n', '--lines', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--depth', type=int, default=4, help="nesting depth of blocks")
+    args = parser.parse_args(argv)
+    program = generate(args.lines, args.seed, args.depth)
+    with open(args.output, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(program) + '\n')
+    print(f"{len(program)} lines -> {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
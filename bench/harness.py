@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from assemble import Assembler
+from bench.generate import generate
+from profiling import Profiler
+
+BENCH_VERSION = 1
+
+# Program sizes in source lines; the largest still fits in the address space
+SIZES = {
+    'small': 2_000,
+    'medium': 20_000,
+    'large': 45_000,
+}
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Stages faster than this in the baseline are too noisy to fail on
+MIN_SECONDS = 0.001
+
+
+def measure(program: list[str], repeat: int = 3, options: dict | None = None) -> dict:
+    """
+    Best of repeat runs of every stage, measured one at a time with a
+    Profiler, and of the streaming end-to-end build without one.
+    """
+    options = options or {}
+    best = {}
+    assembler = None
+    for _ in range(repeat):
+        profiler = Profiler(memory=False)
+        assembler = Assembler(**options, profiler=profiler)
+        assembler.assemble(program)
+        for stage, record in profiler.stages.items():
+            best[stage] = min(best.get(stage, record['seconds']), record['seconds'])
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        Assembler(**options).assemble(program)
+        seconds = time.perf_counter() - started
+        best['end_to_end'] = min(best.get('end_to_end', seconds), seconds)
+
+    return {
+        'lines': len(program),
+        'instructions': len(assembler.lines),
+        'errors': len(assembler.messages),
+        'seconds': best,
+        'lines_per_second': len(program) / best['end_to_end'] if best['end_to_end'] else 0.0,
+    }
+
+
+def run(sizes: dict, repeat: int = 3, seed: int = 0, options: dict | None = None) -> dict:
+    results = {}
+    for name, lines in sizes.items():
+        results[name] = measure(generate(lines, seed), repeat, options)
+    return {
+        'version': BENCH_VERSION,
+        'seed': seed,
+        'options': options or {},
+        'programs': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> tuple[str, list[str]]:
+    """A table of new against baseline times, and the stages slower than 1 + tolerance times the baseline."""
+    lines = [f"{'program':8} {'stage':11} {'baseline':>9} {'now':>9} {'ratio':>6}"]
+    regressions = []
+    for name, result in report['programs'].items():
+        old = baseline['programs'].get(name)
+        for stage, seconds in result['seconds'].items():
+            before = old['seconds'].get(stage) if old is not None else None
+            if not before:
+                lines.append(f"{name:8} {stage:11} {'-':>9} {seconds:9.4f} {'-':>6}")
+                continue
+            ratio = seconds / before
+            mark = ''
+            if ratio > 1 + tolerance and before >= MIN_SECONDS:
+                mark = '  slower'
+                regressions.append(f"{name}/{stage}")
+            lines.append(f"{name:8} {stage:11} {before:9.4f} {seconds:9.4f} {ratio:6.2f}{mark}")
+    return '\n'.join(lines), regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Time the assembler stages on synthetic programs.")
+    parser.add_argument('--lines', type=int, nargs='+', help="program sizes instead of the default set")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one counts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-O', '--optimize', action='store_true')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline JSON to compare with or save to")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="allowed slowdown before failing")
+    parser.add_argument('--json', metavar='PATH', help="also write this run as JSON")
+    args = parser.parse_args(argv)
+
+    sizes = SIZES if not args.lines else {str(lines): lines for lines in args.lines}
+    report = run(sizes, args.repeat, args.seed, {'optimize': args.optimize})
+
+    for name, result in report['programs'].items():
+        errors = f", {result['errors']} errors" if result['errors'] else ''
+        print(f"{name}: {result['lines']} lines, {result['instructions']} instructions{errors}, "
+              f"{result['lines_per_second']:.0f} lines/s end to end")
+
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as fout:
+            json.dump(report, fout, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as fout:
+            json.dump(report, fout, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as fin:
+        baseline = json.load(fin)
+    if baseline.get('version') != BENCH_VERSION or baseline.get('options') != report['options'] \
+            or baseline.get('seed') != report['seed']:
+        print("baseline was made with another version, seed or options, not comparing")
+        return 0
+
+    table, regressions = compare(report, baseline, args.tolerance)
+    print(table)
+    if regressions:
+        print(f"slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
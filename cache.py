@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import tempfile
+from array import array
+
+from main import ENCODINGS
+
+# Bump when the expansion or the encoding of functions changes
+CACHE_VERSION = 8
+
+# Encoded lines kept in memory; the table is emptied by prune when it grows past this
+INSTRUCTIONS_LIMIT = 1 << 16
+
+
+def _encoding_digest() -> str:
+    digest = hashlib.sha256()
+    for key in sorted(ENCODINGS):
+        digest.update(f"{key}={ENCODINGS[key]};".encode())
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """
+    Cache of assembled functions keyed by the hash of their cleaned source.
+    A fragment is kept in memory and, when directory is given, as a JSON
+    file in it, so later builds and other processes can reuse it.
+    instructions maps the text of a base instruction to its encoding for
+    builds in the same process, which covers the code outside functions.
+    previous holds the last build made with the cache, see Assembler.rebuild.
+    """
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self.instructions = {}
+        self.previous = None
+        self._salt = f"{CACHE_VERSION}:{_encoding_digest()}\n".encode()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, lines, options: str = '') -> str:
+        digest = hashlib.sha256(self._salt)
+        digest.update(options.encode('utf-8') + b'\n')
+        for line in lines:
+            digest.update(line.encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key: str, check=None) -> dict | None:
+        """The fragment stored under key, or None. A fragment check(fragment) rejects counts as a miss."""
+        fragment = self.memory.get(key)
+        if fragment is None and self.directory is not None:
+            try:
+                with open(self._path(key), 'r', encoding='utf-8') as fin:
+                    fragment = _load(json.load(fin))
+            except (OSError, ValueError, KeyError):
+                fragment = None
+            if fragment is not None:
+                self.memory[key] = fragment
+
+        if fragment is not None and check is not None and not check(fragment):
+            fragment = None
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(key)
+        return fragment
+
+    def put(self, key: str, fragment: dict):
+        self.memory[key] = fragment
+        self.used.add(key)
+        if self.directory is None:
+            return
+        # Write to a temporary file first so parallel builds never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fout:
+            json.dump(_dump(fragment), fout)
+        os.replace(tmp_path, self._path(key))
+
+    def prune(self):
+        """Forget in-memory fragments not used since the last prune; files on disk stay."""
+        self.memory = {key: fragment for key, fragment in self.memory.items() if key in self.used}
+        self.used = set()
+        if len(self.instructions) > INSTRUCTIONS_LIMIT:
+            self.instructions = {}
+
+
+def _dump(fragment: dict) -> dict:
+    return {
+        'words': fragment['words'].tobytes().hex(),
+        'labels': fragment['labels'],
+        'fixups': fragment['fixups'],
+        'summaries': fragment['summaries'],
+        'lines': fragment['lines'],
+        'data': fragment['data'],
+        'macros': fragment['macros'],
+        'inlined': fragment['inlined'],
+        'callees': fragment['callees'],
+    }
+
+
+def _load(data: dict) -> dict:
+    words = array('H')
+    words.frombytes(bytes.fromhex(data['words']))
+    return {
+        'words': words,
+        'labels': data['labels'],
+        'fixups': [tuple(fixup) for fixup in data['fixups']],
+        'summaries': data['summaries'],
+        'lines': data['lines'],
+        'data': [tuple(data_range) for data_range in data['data']],
+        'macros': [tuple(macro) for macro in data['macros']],
+        'inlined': data['inlined'],
+        'callees': data['callees'],
+    }
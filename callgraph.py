@@ -0,0 +1,59 @@
+from collections import deque
+
+from lexer import tokenize
+
+
+def _owners(blocks: list) -> dict:
+    """Map every function name and every label defined in a function body to its block indices."""
+    owners = {}
+    for index, (function, lines) in enumerate(blocks):
+        if function is None:
+            continue
+        owners.setdefault(function, []).append(index)
+        for _, line in lines:
+            parts = tokenize(line)
+            if parts[0] == "label" and len(parts) == 2:
+                owners.setdefault(parts[1], []).append(index)
+    return owners
+
+
+def references(lines) -> set[str]:
+    """
+    Every operand token of the lines. Labels only appear as operands of call,
+    jmp and conditions, so this covers them; registers and numbers never
+    match a function.
+    """
+    result = set()
+    for _, line in lines:
+        result.update(tokenize(line)[1:])
+    return result
+
+
+def reachable(blocks: list, roots=()) -> set[int]:
+    """
+    Indices of blocks reachable from the top-level code, where the program
+    starts, and from the functions or labels named in roots.
+    """
+    owners = _owners(blocks)
+    found = {index for index, (function, _) in enumerate(blocks) if function is None}
+    for root in roots:
+        found.update(owners.get(root, ()))
+
+    queue = deque(found)
+    while queue:
+        index = queue.popleft()
+        function, lines = blocks[index]
+        for name in references(lines[1:] if function is not None else lines):
+            for owner in owners.get(name, ()):
+                if owner not in found:
+                    found.add(owner)
+                    queue.append(owner)
+    return found
+
+
+def drop_unused(blocks: list, roots=()) -> tuple[list, list]:
+    """Split the blocks of split_functions into (kept blocks, dropped blocks)."""
+    found = reachable(blocks, roots)
+    kept = [block for index, block in enumerate(blocks) if index in found]
+    dropped = [block for index, block in enumerate(blocks) if index not in found]
+    return kept, dropped
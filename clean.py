@@ -1,8 +1,44 @@
+def clean_lines(lines, start: int = 1):
+    """
+    Yield (line_number, code) for every non-empty line with comments stripped.
+    Code is lowercased except inside double quotes. Lines are numbered from start.
+    """
+    for ln, line in enumerate(lines, start):
+        if '"' in line:
+            code = clean_quoted(line)
+        else:
+            code = line.split(';', 1)[0].strip().lower()
+        if code:
+            yield ln, code
+
+
+def clean_quoted(line: str) -> str:
+    """Strip the comment of a line with quotes, keeping ';' and the case between them."""
+    parts = []
+    start = 0
+    inside = False
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if inside:
+            if char == '\\':
+                i += 1
+            elif char == '"':
+                parts.append(line[start:i + 1])
+                start, inside = i + 1, False
+        elif char == '"':
+            parts.append(line[start:i].lower())
+            start, inside = i, True
+        elif char == ';':
+            break
+        i += 1
+    tail = line[start:min(i, len(line))]
+    parts.append(tail if inside else tail.lower())
+    return ''.join(parts).strip()
+
+
 def clean_code(in_path: str, out_path: str):
     with open(in_path, 'r', encoding='utf-8') as fin, \
             open(out_path, 'w', encoding='utf-8') as fout:
-        for line in fin:
-            code = line.split(';', 1)[0].strip()
-            if code:
-                code = code.lower()
-                fout.write(code + "\n")
+        for _, code in clean_lines(fin):
+            fout.write(code + "\n")
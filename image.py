@@ -0,0 +1,193 @@
+import mmap
+import os
+import sys
+from array import array
+
+from main import INSTRUCTION_WORDS
+
+# Optional header, all fields are little-endian u16:
+#   magic, version, entry point, instruction count, label table offset
+# The label table offset is counted in words from the start of the file, 0 means no table.
+# Label table: label count, then for every label its address, name length in bytes
+# and the name itself padded with a zero byte to a whole word.
+MAGIC = 0x4354  # b'TC'
+VERSION = 1
+HEADER_WORDS = 5
+
+WORD_BYTES = 2
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _to_le_bytes(words: array) -> bytes:
+    if LITTLE_ENDIAN:
+        return words.tobytes()
+    swapped = array('H', words)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def read_words(raw) -> array:
+    """Unpack little-endian u16 words from a bytes-like object."""
+    words = array('H')
+    words.frombytes(raw)
+    if not LITTLE_ENDIAN:
+        words.byteswap()
+    return words
+
+
+def pack_image(image: array, header: bool = False, entry: int = 0, labels: dict | None = None) -> bytes:
+    """Return image as packed little-endian u16 words, optionally preceded by the header."""
+    code = _to_le_bytes(image)
+    if not header:
+        if labels:
+            raise ValueError("Label table needs the header")
+        return code
+
+    count = len(image) // INSTRUCTION_WORDS
+    # Numbers are swapped like the code words, names are bytes and never are
+    table = []
+    if labels:
+        if len(labels) > 0xFFFF:
+            raise ValueError(f"{len(labels)} labels do not fit in the u16 count of the label table")
+        table.append(_to_le_bytes(array('H', (len(labels),))))
+        for name, address in labels.items():
+            raw = name.encode('utf-8')
+            if len(raw) > 0xFFFF:
+                raise ValueError(f"Label {name[:32]}... is longer than 65535 bytes")
+            table.append(_to_le_bytes(array('H', (address, len(raw)))))
+            table.append(raw + b'\0' * (len(raw) % WORD_BYTES))
+    table_offset = HEADER_WORDS + len(image) if labels else 0
+
+    head = array('H', (MAGIC, VERSION, entry, count, table_offset))
+    return _to_le_bytes(head) + code + b''.join(table)
+
+
+def write_image(path: str, image: array, header: bool = False, entry: int = 0, labels: dict | None = None):
+    with open(path, 'wb') as fout:
+        fout.write(pack_image(image, header, entry, labels))
+
+
+def include_binary(path: str, offset: int | None = None, length: int | None = None) -> array:
+    """
+    Little-endian u16 words of length bytes of a file from offset, the whole
+    file by default, copied out of an mmap in one buffer operation.
+    An odd last byte becomes the low byte of a final word.
+    """
+    with open(path, 'rb') as fin:
+        size = os.fstat(fin.fileno()).st_size
+        if offset is None:
+            offset, length = 0, size
+        if offset < 0 or length < 0 or offset + length > size:
+            raise ValueError(f"{path}: bytes {offset}..{offset + length} are outside of the file of {size} bytes")
+        if not length:
+            # mmap refuses empty files
+            return array('H')
+        even = length - length % WORD_BYTES
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            with view[offset:offset + even] as chunk:
+                words = read_words(chunk)
+            if length % WORD_BYTES:
+                words.append(view[offset + even])
+    return words
+
+
+class RomImage:
+    """
+    Read-only view of a binary image mapped with mmap.
+    The header is detected by its magic word; without it the whole file is code.
+    words is a memoryview of the code words, instruction(i) returns the four
+    words of instruction i.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            self._mm = None
+        raw = self._raw = memoryview(self._mm if self._mm is not None else b'')
+        if len(raw) % WORD_BYTES:
+            self.close()
+            raise ValueError(f"{path}: odd image size {len(raw)}")
+
+        self.has_header = False
+        self.entry = 0
+        self.labels = {}
+        start, end = 0, len(raw)
+        if len(raw) >= HEADER_WORDS * WORD_BYTES \
+                and int.from_bytes(raw[:WORD_BYTES], 'little') == MAGIC:
+            head = read_words(raw[:HEADER_WORDS * WORD_BYTES])
+            _, version, self.entry, count, table_offset = head
+            if version != VERSION:
+                self.close()
+                raise ValueError(f"{path}: unsupported image version {version}")
+            self.has_header = True
+            start = HEADER_WORDS * WORD_BYTES
+            end = start + count * INSTRUCTION_WORDS * WORD_BYTES
+            if table_offset:
+                self.labels = self._read_labels(raw[table_offset * WORD_BYTES:])
+
+        self.bytes = raw[start:end]
+        if LITTLE_ENDIAN:
+            self.words = self.bytes.cast('H')
+        else:
+            self.words = memoryview(read_words(self.bytes))
+
+    def _read_labels(self, raw) -> dict[str, int]:
+        labels = {}
+        pos = 0
+        (quantity,) = read_words(raw[pos:pos + WORD_BYTES])
+        pos += WORD_BYTES
+        for _ in range(quantity):
+            address, length = read_words(raw[pos:pos + 2 * WORD_BYTES])
+            pos += 2 * WORD_BYTES
+            labels[bytes(raw[pos:pos + length]).decode('utf-8')] = address
+            pos += length + length % WORD_BYTES
+        return labels
+
+    def __len__(self) -> int:
+        return len(self.words) // INSTRUCTION_WORDS
+
+    def instruction(self, index: int) -> tuple[int, int, int, int]:
+        start = index * INSTRUCTION_WORDS
+        return tuple(self.words[start:start + INSTRUCTION_WORDS])
+
+    def close(self):
+        for view in ('words', 'bytes', '_raw'):
+            if hasattr(self, view):
+                getattr(self, view).release()
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+CHUNK_BYTES = 1 << 16
+
+
+def first_difference(a: RomImage, b: RomImage) -> int | None:
+    """
+    Return the index of the first instruction that differs between two images,
+    or None if their code is identical. Only the code words are compared.
+    """
+    size = min(len(a.bytes), len(b.bytes))
+    for start in range(0, size, CHUNK_BYTES):
+        end = min(start + CHUNK_BYTES, size)
+        if a.bytes[start:end] != b.bytes[start:end]:
+            for pos in range(start, end, WORD_BYTES):
+                if a.bytes[pos:pos + WORD_BYTES] != b.bytes[pos:pos + WORD_BYTES]:
+                    return pos // (INSTRUCTION_WORDS * WORD_BYTES)
+    if len(a.bytes) != len(b.bytes):
+        return size // (INSTRUCTION_WORDS * WORD_BYTES)
+    return None
+
+
+def compare_images(path_a: str, path_b: str) -> int | None:
+    with RomImage(path_a) as a, RomImage(path_b) as b:
+        return first_difference(a, b)
@@ -0,0 +1,132 @@
+from array import array
+
+from main import ARG1_FIELD, DST_FIELD, IM1_BIT, INSTRUCTION_WORDS, REGISTERS
+from simulator import DISPATCH, dispatch_index
+
+PC = REGISTERS['pc']
+PC_NEXT = REGISTERS['pc+']
+
+# Kinds whose dst field is a register
+WRITES_DST = {'mov', 'pop', 'calc1', 'calc2'}
+
+
+def _kinds(image, data) -> list:
+    """Kind of every instruction, None for unknown words and the slots of data directives."""
+    kinds = []
+    for i in range(0, len(image), INSTRUCTION_WORDS):
+        entry = DISPATCH[dispatch_index(image[i])]
+        kinds.append(entry[1] if entry is not None else None)
+    for start, slots in data:
+        kinds[start:start + slots] = [None] * slots
+    return kinds
+
+
+def thread_jumps(image: array, labels: dict, references: list, lines: array,
+                 data=()) -> tuple[array, dict, array, list, dict]:
+    """
+    Thread branches through chains of jumps in a laid out image, then remove
+    branches to the next instruction and lay the code out again, until
+    nothing changes. references lists (instruction index, field) of every
+    label operand, which is all that has to move with the layout; lines
+    holds the source line of every instruction and data (first slot, slots)
+    of every data directive, whose words are never taken for code.
+
+    Nothing is removed if the program writes pc in any other way than a
+    jump to a label or 'pop pc', or branches to a number: such a target may
+    be a computed address.
+    A jmp right after 'push pc+' is the jump of a call and stays.
+
+    Returns (image, labels, lines, data, stats) with stats counting retargeted
+    and removed branches.
+    """
+    image = array('H', image)
+    labels = dict(labels)
+    lines = array(lines.typecode, lines)
+    references = sorted(set(references))
+    data = list(data)
+    stats = {'retargeted': 0, 'removed': 0}
+
+    changed = True
+    while changed:
+        changed = False
+        kinds = _kinds(image, data)
+        count = len(kinds)
+        jumps = set()
+        branches = []
+        movable = True
+        for index, field in references:
+            if field == ARG1_FIELD and kinds[index] == 'mov' and image[index * INSTRUCTION_WORDS + DST_FIELD] == PC:
+                jumps.add(index)
+                branches.append((index, field))
+            elif field == DST_FIELD and kinds[index] == 'cond':
+                branches.append((index, field))
+        conditions = {index for index, field in branches if field == DST_FIELD}
+        for index, kind in enumerate(kinds):
+            if kind in WRITES_DST and image[index * INSTRUCTION_WORDS + DST_FIELD] == PC \
+                    and kind != 'pop' and index not in jumps:
+                movable = False
+            elif kind == 'cond' and index not in conditions:
+                movable = False
+
+        def final(target):
+            seen = set()
+            while target in jumps and target not in seen:
+                seen.add(target)
+                target = image[target * INSTRUCTION_WORDS + ARG1_FIELD]
+            return target
+
+        for index, field in branches:
+            position = index * INSTRUCTION_WORDS + field
+            target = final(image[position])
+            if target != image[position]:
+                image[position] = target
+                stats['retargeted'] += 1
+                changed = True
+
+        if not movable:
+            continue
+
+        removed = set()
+        for index, field in branches:
+            if image[index * INSTRUCTION_WORDS + field] != index + 1:
+                continue
+            previous = (index - 1) * INSTRUCTION_WORDS
+            if index > 0 and kinds[index - 1] == 'push' and image[previous + ARG1_FIELD] == PC_NEXT \
+                    and not image[previous] >> IM1_BIT & 1:
+                continue
+            removed.add(index)
+        if not removed:
+            continue
+
+        # Every address moves to the next instruction that stays
+        new_index = []
+        kept = 0
+        for index in range(count + 1):
+            new_index.append(kept)
+            if index not in removed:
+                kept += 1
+
+        new_image = array('H')
+        for index in range(count):
+            if index not in removed:
+                start = index * INSTRUCTION_WORDS
+                new_image.extend(image[start:start + INSTRUCTION_WORDS])
+        new_references = []
+        for index, field in references:
+            if index in removed:
+                continue
+            position = new_index[index] * INSTRUCTION_WORDS + field
+            target = new_image[position]
+            if target <= count:
+                new_image[position] = new_index[target]
+            new_references.append((new_index[index], field))
+
+        image = new_image
+        lines = array(lines.typecode, (ln for index, ln in enumerate(lines) if index not in removed))
+        references = new_references
+        data = [(new_index[start], slots) for start, slots in data]
+        labels = {label: new_index[address] if address <= count else address for label, address in labels.items()}
+        stats['removed'] += len(removed)
+        changed = True
+
+    return image, labels, lines, data, stats
@@ -0,0 +1,106 @@
+import sys
+
+from utils import REGISTERS
+
+# Digits allowed after each prefix of an integer literal
+DIGITS = {
+    10: frozenset('0123456789'),
+    16: frozenset('0123456789abcdefABCDEF'),
+    8: frozenset('01234567'),
+    2: frozenset('01'),
+}
+PREFIXES = {'0x': 16, '0X': 16, '0o': 8, '0O': 8, '0b': 2, '0B': 2}
+NUMBER_START = frozenset('0123456789-+')
+
+# Characters after a backslash in a quoted literal
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '0': '\0', '\\': '\\', '"': '"'}
+
+# Operand kinds
+REGISTER = 'register'
+NUMBER = 'number'
+LABEL = 'label'
+
+# Lines tokenized so far; cleared when it grows past CACHE_LINES
+CACHE_LINES = 1 << 16
+_lines = {}
+_operands = {}
+
+
+def number(tok: str) -> int | None:
+    """
+    The value of a decimal, 0x hex, 0o octal or 0b binary literal with an
+    optional sign, or None. Accepts what int(tok, 0) does: single '_' between
+    digits or after the prefix, no leading zeros in a nonzero decimal.
+    Decided by characters, without catching int() errors.
+    """
+    if not tok or tok[0] not in NUMBER_START:
+        return None
+    sign = 1
+    if tok[0] in '-+':
+        sign = -1 if tok[0] == '-' else 1
+        tok = tok[1:]
+    base = PREFIXES.get(tok[:2], 10)
+    if base != 10:
+        tok = tok[2:]
+        if tok.startswith('_'):
+            tok = tok[1:]
+    if not tok or tok[0] == '_' or tok[-1] == '_' or '__' in tok:
+        return None
+    digits = tok.replace('_', '')
+    if not DIGITS[base].issuperset(digits):
+        return None
+    if base == 10 and digits[0] == '0' and digits.strip('0'):
+        return None
+    return sign * int(digits, base)
+
+
+def quoted(text: str) -> tuple[str, str]:
+    """
+    Read the quoted literal text starts with. Returns its value with the
+    escapes resolved and the rest of text after the closing quote.
+    """
+    if not text.startswith('"'):
+        raise ValueError(f"expected a quoted string, got {text!r}")
+    chars = []
+    i = 1
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            return ''.join(chars), text[i + 1:]
+        if char == '\\':
+            i += 1
+            if i == len(text) or text[i] not in ESCAPES:
+                raise ValueError(f"unknown escape in {text!r}")
+            char = ESCAPES[text[i]]
+        chars.append(char)
+        i += 1
+    raise ValueError(f"unterminated string {text!r}")
+
+
+def tokenize(line: str) -> tuple[str, ...]:
+    """
+    Split a line into interned tokens. Every stage asks for the tokens of
+    the lines it gets, so a line that passes through unchanged is split once.
+    """
+    tokens = _lines.get(line)
+    if tokens is None:
+        if len(_lines) >= CACHE_LINES:
+            _lines.clear()
+        tokens = _lines[line] = tuple([sys.intern(tok) for tok in line.split()])
+    return tokens
+
+
+def operand(tok: str) -> tuple[str, int | str]:
+    """(kind, value) of an operand token: a register id, a number or a label name."""
+    typed = _operands.get(tok)
+    if typed is None:
+        if tok in REGISTERS:
+            typed = (REGISTER, REGISTERS[tok])
+        else:
+            value = number(tok)
+            typed = (LABEL, tok) if value is None else (NUMBER, value)
+        if len(_operands) >= CACHE_LINES:
+            _operands.clear()
+        _operands[tok] = typed
+    return typed
+
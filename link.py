@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import sys
+from array import array
+
+from assemble import Assembler
+from image import pack_image, read_words, write_image
+from main import ADDRESS_SPACE, INSTRUCTION_WORDS, render_text
+
+# Object file: JSON with the module code as little-endian u16 words in hex,
+# every label as an offset from the start of the module, and a relocation
+# (instruction index, field, symbol, source line) for every label operand.
+OBJECT_FORMAT = 'tc-object'
+OBJECT_VERSION = 1
+
+
+def is_local(symbol: str) -> bool:
+    """Labels starting with '_' (system labels included) are private to their module."""
+    return symbol.startswith('_')
+
+
+def assemble_object(source, name: str = '', cache=None, include_dir: str = '') -> tuple[dict, list[str]]:
+    """Assemble one module without resolving its labels. Returns (object, messages)."""
+    assembler = Assembler(relocatable=True, include_dir=include_dir)
+    assembler.build(source, cache=cache)
+    obj = {
+        'name': name,
+        'words': assembler.image,
+        'symbols': assembler.labels,
+        'relocations': assembler.fixups,
+    }
+    return obj, assembler.messages
+
+
+def write_object(path: str, obj: dict):
+    data = {
+        'format': OBJECT_FORMAT,
+        'version': OBJECT_VERSION,
+        'name': obj['name'],
+        'words': pack_image(obj['words']).hex(),
+        'symbols': obj['symbols'],
+        'relocations': obj['relocations'],
+    }
+    with open(path, 'w', encoding='utf-8') as fout:
+        json.dump(data, fout)
+
+
+def read_object(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as fin:
+        data = json.load(fin)
+    if data.get('format') != OBJECT_FORMAT or data.get('version') != OBJECT_VERSION:
+        raise ValueError(f"{path}: not a version {OBJECT_VERSION} object file")
+    return {
+        'name': data['name'],
+        'words': read_words(bytes.fromhex(data['words'])),
+        'symbols': data['symbols'],
+        'relocations': [tuple(relocation) for relocation in data['relocations']],
+    }
+
+
+def link(objects: list[dict]) -> tuple[array, dict, list[str]]:
+    """
+    Lay the modules out in order, the first one at address 0, and resolve
+    their relocations. Returns (image, exported symbols, messages).
+    """
+    image = array('H')
+    symbols = {}
+    owners = {}
+    messages = []
+    placed = []
+
+    for obj in objects:
+        base = len(image) // INSTRUCTION_WORDS
+        local = {}
+        for symbol, offset in obj['symbols'].items():
+            if is_local(symbol):
+                local[symbol] = base + offset
+            elif symbol in symbols:
+                messages.append(
+                    f"Error while link: symbol '{symbol}' defined in both {owners[symbol]} and {obj['name']}"
+                )
+            else:
+                symbols[symbol] = base + offset
+                owners[symbol] = obj['name']
+        image.extend(obj['words'])
+        placed.append((base, local, obj))
+
+    size = len(image) // INSTRUCTION_WORDS
+    if size > ADDRESS_SPACE:
+        messages.append(f"Error while link: {size} instructions do not fit in {ADDRESS_SPACE} addresses")
+        return image, symbols, messages
+
+    for base, local, obj in placed:
+        for index, field, symbol, ln in obj['relocations']:
+            address = local.get(symbol) if is_local(symbol) else symbols.get(symbol)
+            if address is None:
+                messages.append(f"Error while link: {obj['name']}: {ln}: symbol '{symbol}' is not defined")
+                continue
+            if address >= ADDRESS_SPACE:
+                messages.append(f"Error while link: {obj['name']}: {ln}: symbol '{symbol}' at {address} "
+                                f"is outside of the {ADDRESS_SPACE} addresses")
+                continue
+            image[(base + index) * INSTRUCTION_WORDS + field] = address
+
+    return image, symbols, messages
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Assemble modules to object files and link them.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = commands.add_parser('compile', help="assemble sources to object files")
+    compile_parser.add_argument('sources', nargs='+')
+    compile_parser.add_argument('-o', '--out-dir', help="directory for object files (default: next to each source)")
+
+    link_parser = commands.add_parser('link', help="link object files into an image")
+    link_parser.add_argument('objects', nargs='+', help="object files, the first one holds the entry point")
+    link_parser.add_argument('-o', '--output', required=True)
+    link_parser.add_argument('-f', '--format', choices=('text', 'bin'), default='text')
+
+    args = parser.parse_args(argv)
+    failed = False
+
+    if args.command == 'compile':
+        for source in args.sources:
+            with open(source, 'r', encoding='utf-8') as fin:
+                obj, messages = assemble_object(fin, os.path.basename(source), include_dir=os.path.dirname(source))
+            for message in messages:
+                print(f"{source}: {message}")
+            if messages:
+                failed = True
+                continue
+            directory = args.out_dir if args.out_dir is not None else os.path.dirname(source)
+            path = os.path.join(directory, os.path.splitext(os.path.basename(source))[0] + '.tco')
+            write_object(path, obj)
+            print(f"{source} -> {path}")
+
+    else:
+        image, symbols, messages = link([read_object(path) for path in args.objects])
+        for message in messages:
+            print(message)
+        failed = bool(messages)
+        if not failed:
+            if args.format == 'bin':
+                write_image(args.output, image, header=True, labels=symbols)
+            else:
+                with open(args.output, 'w', encoding='utf-8') as fout:
+                    fout.write(render_text(image))
+            print(f"{len(image) // INSTRUCTION_WORDS} instructions -> {args.output}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+from lexer import tokenize
+from main import CALC_CODES_ONE_ARG, CALC_CODES_TWO_ARGS, CALLEE_SAVED, CONDITION_CODES
+
+# Registers tracked by the analysis, one bit each
+TRACKED = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'rv']
+BIT = {register: 1 << i for i, register in enumerate(TRACKED)}
+ALL = (1 << len(TRACKED)) - 1
+
+# Live at 'pop pc': the return value and the registers the caller expects to be preserved
+RETURN_LIVE = BIT['rv'] | sum(BIT[register] for register in CALLEE_SAVED)
+
+# Placeholders the macro expander puts where automatic saves are decided later
+SAVE_MARKER = '.save'
+RESTORE_MARKER = '.restore'
+
+
+def mask(registers) -> int:
+    result = 0
+    for register in registers:
+        result |= BIT.get(register, 0)
+    return result
+
+
+def registers(bits: int) -> list[str]:
+    return [register for register in TRACKED if bits & BIT[register]]
+
+
+def effects(parts: list) -> tuple[int, int, str | None]:
+    """
+    Return (uses, defs, control) of one expanded line. control is None for
+    straight-line code, 'jump' for an unconditional transfer to parts[-1],
+    'branch' for a condition, 'return' for pop pc, 'exit', or 'unknown' for
+    any other write to pc.
+    """
+    op = parts[0]
+    if op == 'mov' and len(parts) == 3:
+        if parts[2] == 'pc':
+            return mask(parts[1:2]), 0, 'unknown'
+        return mask(parts[1:2]), mask(parts[2:3]), None
+    if op == 'push' and len(parts) == 2:
+        return mask(parts[1:2]), 0, None
+    if op == 'pop' and len(parts) == 2:
+        if parts[1] == 'pc':
+            return 0, 0, 'return'
+        return 0, mask(parts[1:2]), None
+    if op == 'jmp' and len(parts) == 2:
+        return mask(parts[1:2]), 0, 'jump'
+    if op in CONDITION_CODES and len(parts) == 4:
+        return mask(parts[1:3]), 0, 'branch'
+    if op in CALC_CODES_ONE_ARG and len(parts) == 3:
+        if parts[2] == 'pc':
+            return mask(parts[1:2]), 0, 'unknown'
+        return mask(parts[1:2]), mask(parts[2:3]), None
+    if op in CALC_CODES_TWO_ARGS and len(parts) == 4:
+        if parts[3] == 'pc':
+            return mask(parts[1:3]), 0, 'unknown'
+        return mask(parts[1:3]), mask(parts[3:4]), None
+    if op == 'exit':
+        return 0, 0, 'exit'
+    return 0, 0, None
+
+
+def analyze(code: list[str], summaries: dict | None = None, falls_out: int = ALL) -> list[int]:
+    """
+    Backward liveness over a region of expanded code. Returns the registers
+    live on entry to every line as bit masks.
+
+    A 'push pc+' followed by 'jmp f' is a call: it returns to the next line,
+    reads the registers in summaries[f] (all of them if f is unknown) and, as
+    caller-saved registers around it are saved when live, kills nothing.
+    Jumps to labels outside the region and computed jumps keep everything
+    live; falls_out is what is live after the last line.
+    """
+    summaries = summaries or {}
+    parts_list = [tokenize(line) for line in code]
+    positions = {parts[1]: i for i, parts in enumerate(parts_list) if parts[0] == 'label' and len(parts) == 2}
+    size = len(parts_list)
+
+    uses = [0] * size
+    defs = [0] * size
+    successors = [()] * size
+    exits = [0] * size
+    for i, parts in enumerate(parts_list):
+        use, define, control = effects(parts)
+        nxt = (i + 1,) if i + 1 < size else ()
+        exit_live = 0 if nxt else falls_out
+        if control == 'jump':
+            target = parts[1]
+            if i > 0 and parts_list[i - 1] == ('push', 'pc+'):
+                use |= summaries.get(target, ALL)
+            elif target in positions:
+                nxt, exit_live = (positions[target],), 0
+            else:
+                nxt, exit_live = (), ALL
+        elif control == 'branch':
+            target = positions.get(parts[3])
+            if target is None:
+                exit_live |= ALL
+            else:
+                nxt = nxt + (target,)
+        elif control == 'return':
+            nxt, exit_live = (), RETURN_LIVE
+        elif control == 'exit':
+            nxt, exit_live = (), 0
+        elif control == 'unknown':
+            nxt, exit_live = (), ALL
+        uses[i] = use
+        defs[i] = define
+        successors[i] = nxt
+        exits[i] = exit_live
+
+    live_in = [0] * size
+    changed = True
+    while changed:
+        changed = False
+        for i in range(size - 1, -1, -1):
+            out = exits[i]
+            for successor in successors[i]:
+                out |= live_in[successor]
+            new = uses[i] | (out & ~defs[i])
+            if new != live_in[i]:
+                live_in[i] = new
+                changed = True
+    return live_in
+
+
+def written(code: list[str]) -> int:
+    """Registers any line of code writes."""
+    result = 0
+    for line in code:
+        result |= effects(tokenize(line))[1]
+    return result
@@ -1,7 +1,7 @@
-import re
+import os
+from array import array
 
-from clean import clean_code
-from unpack_macro import unpack_macro_commands
+from lexer import LABEL, NUMBER, REGISTER, number, operand, quoted, tokenize
 
 INPUT_FILE = 'C:/Users/1/Documents/TuringComplete/input.txt'
 CLEAN_FILE = 'C:/Users/1/Documents/TuringComplete/clean.txt'
@@ -9,6 +9,38 @@ RESOLVED_MACRO_FILE = 'C:/Users/1/Documents/TuringComplete/resovled_macro.txt'
 LABELS_FILE = 'C:/Users/1/Documents/TuringComplete/with_labels.txt'
 OUTPUT_FILE = 'C:/Users/1/Documents/TuringComplete/output.txt'
 
+# 'text' writes decimal words, 'bin' a packed little-endian u16 image (see image.py)
+OUTPUT_FORMAT = 'text'
+# Prefix the binary image with the header and the label table
+BINARY_HEADER = True
+
+# Run the peephole optimizer between macro expansion and assembly
+OPTIMIZE = False
+# Test for/while conditions at the bottom of the loop; False keeps the test at the top
+ROTATE_LOOPS = True
+# Turn a call followed by 'ret rv' into a jump that reuses the caller's frame
+TAIL_CALLS = True
+# Leave 'push bp', 'mov sp bp' and 'pop bp' out of functions without locals that never name bp or sp
+OMIT_FRAME_POINTER = True
+# Leave out functions the top-level code never reaches; KEEP names extra roots
+DROP_UNUSED = False
+KEEP = []
+# Also inline calls without arguments of functions of at most this many lines, 0 for 'inline def' only
+INLINE_THRESHOLD = 0
+
+# Write the address -> source line table next to the output, None to skip it
+SOURCE_MAP_FILE = None
+
+# Measure every pipeline stage; PROFILE_FILE also gets the report as JSON
+PROFILE = False
+PROFILE_FILE = None
+
+# Directory of the per-function build cache, None to rebuild everything
+CACHE_DIR = None
+
+# Write CLEAN_FILE, RESOLVED_MACRO_FILE and LABELS_FILE for debugging
+DUMP_INTERMEDIATE = False
+
 
 def to_u16(x: int) -> int:
     return x & 0xFFFF
@@ -98,6 +130,8 @@ CALC_CODES_TWO_ARGS = {
     'add', 'sub', 'mul', 'div', 'mod',
 }
 CONDITION_CODES = {'eq', 'lt', 'lte', 'gt', 'gte', 'lts', 'ltes', 'gts', 'gtes'}
+# Directives that place raw words instead of an instruction
+DATA_DIRECTIVES = {'word', 'words', 'string', 'incbin'}
 
 REGISTERS = {
     'r0': 0,
@@ -117,35 +151,38 @@ REGISTERS = {
 CALLER_SAVED = ['r0', 'r1', 'r2']
 CALLEE_SAVED = ['r3', 'r4', 'r5']
 
-labels = {}
-command_line = 0
-current_function = {
-    'callee_saved': [],
-    'reserved': 0,
-    'is_active': False,
-}
-error_counter = 0
-
-
-def increase_error_counter():
-    global error_counter
-    error_counter += 1
-
 
-def find_opcode_path(name: str):
+def build_encodings() -> dict[tuple[str, bool, bool], int]:
     """
-    Search FUNCS for the given opcode name and return a tuple:
-        (main_category, sub_category, opcode_name)
-    Raises ValueError if not found.
+    Precompute the finished instruction word for every mnemonic and
+    imm1/imm2 combination, so encoding is a single lookup.
+    Raises ValueError if a mnemonic appears in more than one category.
     """
-    for main_cat, subcats in FUNCS.items():
-        for sub_cat, ops in subcats.items():
-            if name in ops:
-                return main_cat, sub_cat, name
-    raise ValueError(f"Opcode '{name}' not found in FUNCS")
-
-
-def check_length(parts: list, expect: int, op: str):
+    table = {}
+    owners = {}
+    for opcode, op_types in FUNCS.items():
+        for op_type, funcs in op_types.items():
+            for func, func_code in funcs.items():
+                if func in owners:
+                    raise ValueError(
+                        f"Opcode '{func}' defined in both {owners[func]} and {opcode}/{op_type}"
+                    )
+                owners[func] = f"{opcode}/{op_type}"
+
+                base = (OPCODES[opcode] << OPCODE_SHIFT) \
+                    | (TYPES[opcode][op_type] << SUBTYPE_SHIFT) \
+                    | (func_code << SUBFUNC_SHIFT)
+                for imm1 in (False, True):
+                    for imm2 in (False, True):
+                        w = base | (imm1 << IM1_BIT) | (imm2 << IM2_BIT)
+                        table[func, imm1, imm2] = to_u16(w)
+    return table
+
+
+ENCODINGS = build_encodings()
+
+
+def check_length(parts: tuple, expect: int, op: str):
     if len(parts) != expect:
         raise ValueError(f"{op} expects {expect - 1} operands, got {len(parts) - 1}")
 
@@ -170,97 +207,203 @@ def parse_operand(tok: str, operand_type: str) -> tuple[int, bool] | tuple[str,
     else:
         raise ValueError(f"Unknown operand type {operand_type}. Expect 'src', 'dst', 'jmp' or 'goto'")
 
-    try:
-        num = int(tok, 0)
-    except ValueError:
-        pass
-    else:
+    kind, value = operand(tok)
+    if kind == NUMBER:
         if ALLOW_NUMBER:
-            return to_u16(num), True
+            return to_u16(value), True
         else:
             raise ValueError(f"Number as operand is not allowed with {operand_type} operand type.")
 
-    if tok in REGISTERS:
+    if kind == REGISTER:
         if ALLOW_REGISTER:
-            return to_u16(REGISTERS[tok]), False
+            return to_u16(value), False
         else:
             raise ValueError(f"Register as operand is not allowed with {operand_type} operand type.")
 
-    if ALLOW_LABELS:
-        return '#' + tok, True
+    if kind == LABEL and ALLOW_LABELS:
+        return tok, True
 
     raise ValueError(f"Invalid operand {tok!r} for type {operand_type!r}")
 
 
 def create_command(imm1: bool, imm2: bool, func: str) -> int:
-    opcode, op_type, op_func = find_opcode_path(func)
-    w = 0
-    w |= (imm1 << IM1_BIT)
-    w |= (imm2 << IM2_BIT)
-    w |= (OPCODES[opcode] << OPCODE_SHIFT)
-    w |= (TYPES[opcode][op_type] << SUBTYPE_SHIFT)
-    w |= (FUNCS[opcode][op_type][op_func] << SUBFUNC_SHIFT)
-    return to_u16(w)
+    try:
+        return ENCODINGS[func, imm1, imm2]
+    except KeyError:
+        raise ValueError(f"Opcode '{func}' not found in FUNCS") from None
 
 
-def to_string(*inp) -> str:
-    result = ""
-    for element in inp:
-        result = result + str(element) + " "
-    result = result[:-1] + "\n"
-    return result
+# Word positions inside one instruction
+W0_FIELD = 0
+ARG1_FIELD = 1
+ARG2_FIELD = 2
+DST_FIELD = 3
+INSTRUCTION_WORDS = 4
+# Addresses are instruction indices in a 16-bit word
+ADDRESS_SPACE = 0x10000
 
 
-def parse_multi(lines: list) -> str:
+class Instruction:
+    """
+    One encoded instruction: the command word and its three operand words.
+    An operand given as a label name is stored as a fixup (field, label)
+    and the operand word stays 0 until the label is resolved.
+    """
+    __slots__ = ('w0', 'arg1', 'arg2', 'dst', 'fixup')
+    slots = 1
+
+    def __init__(self, w0: int, arg1: int | str = EMPTY, arg2: int = EMPTY, dst: int | str = EMPTY):
+        self.fixup = None
+        if isinstance(arg1, str):
+            self.fixup = (ARG1_FIELD, arg1)
+            arg1 = 0
+        if isinstance(dst, str):
+            self.fixup = (DST_FIELD, dst)
+            dst = 0
+        self.w0 = w0
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.dst = dst
+
+    def words(self) -> tuple[int, int, int, int]:
+        return self.w0, self.arg1, self.arg2, self.dst
+
+    def __str__(self) -> str:
+        words = [str(w) for w in self.words()]
+        if self.fixup:
+            field, label = self.fixup
+            words[field] = '#' + label
+        return ' '.join(words)
+
+
+class Data:
+    """
+    Raw words of a data directive, padded with zeros to whole instruction
+    slots, so the addresses of the code after it stay instruction indices.
+    fixups lists (word offset, label) of the words given as label names.
+    """
+    __slots__ = ('data', 'fixups', 'slots')
+
+    def __init__(self, data: array, fixups: list | None = None):
+        data.extend([0] * (-len(data) % INSTRUCTION_WORDS))
+        self.data = data
+        self.fixups = fixups or []
+        self.slots = len(data) // INSTRUCTION_WORDS
+
+    def words(self) -> array:
+        return self.data
+
+
+def parse_multi(lines: list, labels: dict) -> list[Instruction | Data]:
     parsed = []
+    address = 0
     for line in lines:
-        result = parse_line(line)
+        result = parse_line(line, labels, address)
         if result:
             parsed.append(result)
-    return ''.join(parsed)
+            address += result.slots
+    return parsed
+
+
+def parse_data(line: str, op: str, include_dir: str = '') -> Data:
+    """
+    Encode a data directive: 'word VALUE', 'words VALUE...', 'string "TEXT"'
+    (zero-terminated, one character per word) or 'incbin PATH [OFFSET LENGTH]'
+    (little-endian words of a file, offset and length in bytes, the path
+    relative to include_dir). A value may be a label.
+    """
+    operands = line[len(op):].strip()
+    words = array('H')
+    fixups = []
+    match op:
+        case "word" | "words":
+            values = tokenize(operands)
+            if op == "word" and len(values) != 1:
+                raise ValueError(f"word expects 1 value, got {len(values)}")
+            if not values:
+                raise ValueError("words expects at least one value")
+            for tok in values:
+                kind, value = operand(tok)
+                if kind == REGISTER:
+                    raise ValueError(f"Register {tok} is not a data value")
+                if kind == LABEL:
+                    fixups.append((len(words), tok))
+                    value = 0
+                words.append(to_u16(value))
+
+        case "string":
+            text, rest = quoted(operands)
+            if rest.strip():
+                raise ValueError(f"Unexpected {rest.strip()!r} after the string")
+            for char in text:
+                if ord(char) > 0xFFFF:
+                    raise ValueError(f"Character {char!r} does not fit in a word")
+                words.append(ord(char))
+            words.append(0)
+
+        case "incbin":
+            # image imports this module
+            from image import include_binary
+            if operands.startswith('"'):
+                path, rest = quoted(operands)
+            else:
+                path, _, rest = operands.partition(' ')
+            bounds = [number(tok) for tok in rest.split()]
+            if not path or len(bounds) not in (0, 2) or None in bounds:
+                raise ValueError("incbin expects a path, then optionally an offset and a length in bytes")
+            try:
+                words = include_binary(os.path.join(include_dir, path), *bounds)
+            except OSError as e:
+                raise ValueError(f"incbin can not read {path}: {e.strerror}") from None
 
+    return Data(words, fixups)
 
-def parse_line(line: str) -> str | None:
-    global command_line
 
-    parts = line.lower().split()
+def parse_line(line: str, labels: dict, address: int, include_dir: str = '') -> Instruction | Data | None:
+    """
+    Encode one base instruction or data directive. A label line is recorded
+    in labels at address, the index of the next instruction, and yields None.
+    """
+    parts = tokenize(line.lower())
     op = parts[0]
+    if op in DATA_DIRECTIVES:
+        return parse_data(line, op, include_dir)
     def _check_length(expect): check_length(parts, expect, op)
 
     match op:
         case "nop":
             w0 = create_command(False, False, op)
-            return to_string(0, EMPTY, EMPTY, EMPTY)
+            return Instruction(0, EMPTY, EMPTY, EMPTY)
 
         case "exit":
             w0 = create_command(False, False, op)
-            return to_string(w0, EMPTY, EMPTY, EMPTY)
+            return Instruction(w0, EMPTY, EMPTY, EMPTY)
 
         case "mov":
             _check_length(3)
             src, imm1 = parse_operand(parts[1], 'src')
             dst, _ = parse_operand(parts[2], 'dst')
             w0 = create_command(imm1, False, op)
-            return to_string(w0, src, EMPTY, dst)
+            return Instruction(w0, src, EMPTY, dst)
 
         case "push":
             _check_length(2)
             src, imm1 = parse_operand(parts[1], 'src')
             w0 = create_command(imm1, False, op)
-            return to_string(w0, src, EMPTY, EMPTY)
+            return Instruction(w0, src, EMPTY, EMPTY)
 
         case "pop":
             _check_length(2)
             dst, _ = parse_operand(parts[1], 'dst')
             w0 = create_command(False, False, op)
-            return to_string(w0, EMPTY, EMPTY, dst)
+            return Instruction(w0, EMPTY, EMPTY, dst)
 
         case "label":
             _check_length(2)
             label = parts[1]
             if label in labels:
-                raise KeyError(f"Label {label} already in labels. Each label should appear once.")
-            labels[label] = command_line
+                raise ValueError(f"Label {label} already in labels. Each label should appear once.")
+            labels[label] = address
             return None
 
         case "jmp":
@@ -268,14 +411,14 @@ def parse_line(line: str) -> str | None:
             src, imm1 = parse_operand(parts[1], 'jmp')
             dst, _ = parse_operand('pc', 'dst')
             w0 = create_command(imm1, False, 'mov')
-            return to_string(w0, src, EMPTY, dst)
+            return Instruction(w0, src, EMPTY, dst)
 
         case op if op in CALC_CODES_ONE_ARG:
             _check_length(3)
             arg1, imm1 = parse_operand(parts[1], 'src')
             dst, _ = parse_operand(parts[2], 'dst')
             w0 = create_command(imm1, False, op)
-            return to_string(w0, arg1, EMPTY, dst)
+            return Instruction(w0, arg1, EMPTY, dst)
 
         case op if op in CALC_CODES_TWO_ARGS:
             _check_length(4)
@@ -283,7 +426,7 @@ def parse_line(line: str) -> str | None:
             arg2, imm2 = parse_operand(parts[2], 'src')
             dst, _ = parse_operand(parts[3], 'dst')
             w0 = create_command(imm1, imm2, op)
-            return to_string(w0, arg1, arg2, dst)
+            return Instruction(w0, arg1, arg2, dst)
 
         case op if op in CONDITION_CODES:
             _check_length(4)
@@ -291,54 +434,68 @@ def parse_line(line: str) -> str | None:
             arg2, imm2 = parse_operand(parts[2], 'src')
             value, _ = parse_operand(parts[3], 'goto')
             w0 = create_command(imm1, imm2, op,)
-            return to_string(w0, arg1, arg2, value)
+            return Instruction(w0, arg1, arg2, value)
 
         case _:
             raise ValueError(f"Unknown opcode '{op}'")
 
 
-def base_assemble_file(in_path: str, out_path: str):
-    global error_counter
-    with open(in_path, 'r', encoding='utf-8') as fin, \
-            open(out_path, 'w', encoding='utf-8') as fout:
-        global command_line
-        for ln, line in enumerate(fin, 1):
-            try:
-                parsed = parse_line(line)
-                if parsed:
-                    command_line += 1
-                    fout.write(parsed)
-
-            except ValueError as e:
-                increase_error_counter()
-                print(f"Error while assemble: {ln}: {e}")
-                continue
+# One instruction of the text format
+TEXT_LINE = ' '.join(['%d'] * INSTRUCTION_WORDS) + "\n"
 
 
-def resolve_labels(in_path: str, out_path: str):
-    pattern = re.compile(r'#(\w+)')
-    with open(in_path, 'r', encoding='utf-8') as fin, \
-            open(out_path, 'w', encoding='utf-8') as fout:
-
-        for line in fin:
-            def _repl(m):
-                key = m.group(1)
-                try:
-                    return str(labels[key])
-                except KeyError:
-                    increase_error_counter()
-                    print(f"Label '{key}' not found in labels dict")
-
-            new_line = pattern.sub(_repl, line)
-            fout.write(new_line)
+def render_text(image: array) -> str:
+    """Render an image in the text format: one instruction of four decimal words per line."""
+    return (TEXT_LINE * (len(image) // INSTRUCTION_WORDS)) % tuple(image)
 
 
 if __name__ == '__main__':
+    dumps = None
+    if DUMP_INTERMEDIATE:
+        dumps = {
+            'clean': CLEAN_FILE,
+            'macro': RESOLVED_MACRO_FILE,
+            'labels': LABELS_FILE,
+        }
+
+    from assemble import Assembler
+    from cache import BuildCache
+
+    from profiling import Profiler, format_report
+
+    cache = BuildCache(CACHE_DIR) if CACHE_DIR is not None else None
+    profiler = Profiler() if PROFILE else None
+    assembler = Assembler(optimize=OPTIMIZE, rotate_loops=ROTATE_LOOPS, tail_calls=TAIL_CALLS,
+                          omit_frame_pointer=OMIT_FRAME_POINTER,
+                          drop_unused=DROP_UNUSED, keep=KEEP, profiler=profiler,
+                          include_dir=os.path.dirname(INPUT_FILE), inline_threshold=INLINE_THRESHOLD)
+    with open(INPUT_FILE, 'r', encoding='utf-8') as fin:
+        image = assembler.assemble(fin, dumps, cache)
+    if profiler is not None:
+        profiler.stop()
+        print(format_report(profiler.report()))
+        if PROFILE_FILE is not None:
+            profiler.write(PROFILE_FILE, source=INPUT_FILE, instructions=len(assembler.lines))
+    for message in assembler.messages:
+        print(message)
+    if assembler.peephole is not None:
+        print(assembler.peephole.report())
+    if assembler.threading is not None:
+        print(f"jump threading retargeted {assembler.threading['retargeted']} branches, "
+              f"removed {assembler.threading['removed']}")
+    if assembler.drop_unused:
+        print(assembler.drop_report())
+    if assembler.expander.inlined:
+        print(assembler.inline_report())
+    if OUTPUT_FORMAT == 'bin':
+        from image import write_image
+        write_image(OUTPUT_FILE, image, header=BINARY_HEADER, labels=assembler.labels if BINARY_HEADER else None)
+    else:
+        with open(OUTPUT_FILE, 'w', encoding='utf-8') as fout:
+            fout.write(render_text(image))
 
-    clean_code(INPUT_FILE, CLEAN_FILE)
-    unpack_macro_commands(CLEAN_FILE, RESOLVED_MACRO_FILE)
-
-    base_assemble_file(RESOLVED_MACRO_FILE, LABELS_FILE)
-    resolve_labels(LABELS_FILE, OUTPUT_FILE)
+    if SOURCE_MAP_FILE is not None:
+        from sourcemap import write_source_map
+        write_source_map(SOURCE_MAP_FILE, assembler.source_map(INPUT_FILE))
 
-    print(labels)
+    print(assembler.labels)
@@ -0,0 +1,210 @@
+from lexer import number, tokenize
+from main import CALC_CODES_ONE_ARG, CALC_CODES_TWO_ARGS, to_u16
+from simulator import CALC_FUNCS
+from utils import INVERSE_CONDITIONS, is_register
+
+# Registers whose value depends on the address of the instruction or on the stack
+POSITION_REGISTERS = {'pc', 'pc-', 'pc+', 'sp'}
+
+# Calculations whose second operand is a shift count
+SHIFTS = {'shl', 'shr', 'ashr', 'rol', 'ror'}
+
+# Lines kept back before they are emitted, so a rule can look behind a removed pair
+RETAIN = 16
+
+
+# (mnemonic, operand) pairs that leave the other operand unchanged, by the operand's position
+RIGHT_IDENTITIES = {
+    ('add', 0), ('sub', 0), ('or', 0), ('xor', 0), ('mul', 1), ('div', 1), ('and', 0xFFFF),
+    ('shl', 0), ('shr', 0), ('rol', 0), ('ror', 0), ('ashr', 0),
+}
+LEFT_IDENTITIES = {('add', 0), ('or', 0), ('xor', 0), ('mul', 1), ('and', 0xFFFF)}
+
+
+def _instructions(parts_list) -> int:
+    return sum(1 for parts in parts_list if parts[0] != 'label')
+
+
+def _number(tok: str) -> int | None:
+    """The u16 value of an immediate operand, None for registers and labels."""
+    value = number(tok)
+    return None if value is None else to_u16(value)
+
+
+def _power_of_two(value: int | None) -> int | None:
+    if value is None or value == 0 or value & (value - 1):
+        return None
+    return value.bit_length() - 1
+
+
+def jump_to_next(out):
+    """jmp X; label X -> label X"""
+    if len(out) < 2:
+        return None
+    jump, label = out[-2][1], out[-1][1]
+    if jump[0] != 'jmp' or len(jump) != 2 or label[0] != 'label' or len(label) != 2 or jump[1] != label[1]:
+        return None
+    if len(out) > 2:
+        previous = out[-3][1]
+        # push pc+ stores the address after the next instruction, the jmp must stay there
+        if 'pc+' in previous:
+            return None
+        # After a computed jump ('add r pc pc') every jmp up to the next label is
+        # an entry of its table, and so is one after another jmp
+        if previous[0] == 'jmp' or previous[-1] == 'pc':
+            return None
+    return 2, [out[-1]]
+
+
+def push_pop(out):
+    """push r; pop r -> nothing, push r; pop q -> mov r q"""
+    if len(out) < 2:
+        return None
+    (ln, push), (_, pop) = out[-2], out[-1]
+    if push[0] != 'push' or pop[0] != 'pop' or len(push) != 2 or len(pop) != 2:
+        return None
+    if push[1] in POSITION_REGISTERS or pop[1] in POSITION_REGISTERS:
+        return None
+    if push[1] == pop[1]:
+        return 2, []
+    return 2, [(ln, ['mov', push[1], pop[1]])]
+
+
+def self_move(out):
+    """mov a a; add a 0 a; sub a 0 a -> nothing"""
+    ln, parts = out[-1]
+    if parts[0] == 'mov' and len(parts) == 3 and parts[1] == parts[2]:
+        return 1, []
+    if parts[0] in ('add', 'sub') and len(parts) == 4 and parts[1] == parts[3] and parts[2] == '0':
+        return 1, []
+    return None
+
+
+def branch_over_jump(out):
+    """cond a b Lt; jmp Lf; label Lt -> inverse-cond a b Lf; label Lt"""
+    if len(out) < 3:
+        return None
+    (ln, cond), (_, jump), (_, label) = out[-3], out[-2], out[-1]
+    if cond[0] not in INVERSE_CONDITIONS or len(cond) != 4:
+        return None
+    if jump[0] != 'jmp' or len(jump) != 2 or label[0] != 'label' or len(label) != 2 or cond[3] != label[1]:
+        return None
+    # A condition jumps to an address or a label, never through a register
+    if is_register(jump[1]):
+        return None
+    return 3, [(ln, [INVERSE_CONDITIONS[cond[0]], cond[1], cond[2], jump[1]]), out[-1]]
+
+
+def fold_constants(out):
+    """add 3 4 r0 -> mov 7 r0, with the u16 semantics of the target"""
+    ln, parts = out[-1]
+    if parts[0] in CALC_CODES_TWO_ARGS and len(parts) == 4:
+        values = [_number(parts[1]), _number(parts[2])]
+    elif parts[0] in CALC_CODES_ONE_ARG and len(parts) == 3:
+        values = [_number(parts[1])]
+    else:
+        return None
+    if None in values:
+        return None
+    # What a division by zero or a shift by 16 or more gives is up to the machine, not the assembler
+    if parts[0] in ('div', 'mod') and values[1] == 0:
+        return None
+    if parts[0] in SHIFTS and values[1] > 15:
+        return None
+    return 1, [(ln, ['mov', str(CALC_FUNCS[parts[0]](*values)), parts[-1]])]
+
+
+def identity(out):
+    """add x 0 y; mul 1 x y; and x 65535 y; ... -> mov x y"""
+    ln, parts = out[-1]
+    if parts[0] not in CALC_CODES_TWO_ARGS or len(parts) != 4:
+        return None
+    op, arg1, arg2, dst = parts
+    if (op, _number(arg2)) in RIGHT_IDENTITIES:
+        return 1, [(ln, ['mov', arg1, dst])]
+    if (op, _number(arg1)) in LEFT_IDENTITIES:
+        return 1, [(ln, ['mov', arg2, dst])]
+    return None
+
+
+def strength_reduction(out):
+    """mul x 2^k y -> shl x k y, div x 2^k y -> shr x k y, mod x 2^k y -> and x 2^k-1 y"""
+    ln, parts = out[-1]
+    if parts[0] not in ('mul', 'div', 'mod') or len(parts) != 4:
+        return None
+    op, arg1, arg2, dst = parts
+    shift = _power_of_two(_number(arg2))
+    if shift is None and op == 'mul':
+        shift = _power_of_two(_number(arg1))
+        arg1, arg2 = arg2, arg1
+    if shift is None:
+        return None
+    if op == 'mul':
+        return 1, [(ln, ['shl', arg1, str(shift), dst])]
+    if op == 'div':
+        return 1, [(ln, ['shr', arg1, str(shift), dst])]
+    return 1, [(ln, ['and', arg1, str((1 << shift) - 1), dst])]
+
+
+RULES = {
+    'fold-constants': fold_constants,
+    'identity': identity,
+    'strength-reduction': strength_reduction,
+    'jump-to-next': jump_to_next,
+    'push-pop': push_pop,
+    'self-move': self_move,
+    'branch-over-jump': branch_over_jump,
+}
+
+
+class PeepholeOptimizer:
+    """
+    Rule-based optimizer over macro-expanded code. Lines enter a sliding
+    window one by one; after every line each rule is tried on the end of the
+    window until none applies. removed counts the instructions each rule saved,
+    applied how many times it fired.
+    """
+
+    def __init__(self, rules: dict | None = None):
+        self.rules = RULES if rules is None else rules
+        self.removed = {name: 0 for name in self.rules}
+        self.applied = {name: 0 for name in self.rules}
+
+    def _reduce(self, out: list):
+        changed = True
+        while changed and out:
+            changed = False
+            for name, rule in self.rules.items():
+                result = rule(out)
+                if result is None:
+                    continue
+                size, replacement = result
+                window = out[-size:]
+                del out[-size:]
+                out.extend(replacement)
+                self.removed[name] += _instructions(p for _, p in window) - _instructions(p for _, p in replacement)
+                self.applied[name] += 1
+                changed = True
+                break
+
+    def optimize(self, lines):
+        """Optimize (line_number, code) pairs, yielding the optimized pairs."""
+        out = []
+        for ln, line in lines:
+            # A quoted string keeps its spacing: the whole line is one part no rule matches
+            out.append((ln, (line,) if '"' in line else tokenize(line)))
+            self._reduce(out)
+            if len(out) > 2 * RETAIN:
+                for ln_out, parts in out[:-RETAIN]:
+                    yield ln_out, ' '.join(parts)
+                del out[:-RETAIN]
+        for ln_out, parts in out:
+            yield ln_out, ' '.join(parts)
+
+    def report(self) -> str:
+        total = sum(self.removed.values())
+        lines = [
+            f"{name}: {self.removed[name]} removed, {count} applied"
+            for name, count in self.applied.items() if count
+        ]
+        return f"peephole removed {total} instructions" + ''.join(f"\n    {line}" for line in lines)
@@ -0,0 +1,385 @@
+import argparse
+import sys
+import time
+from array import array
+
+from image import MAGIC, RomImage
+from sourcemap import SourceMap
+from main import (
+    CALC_CODES_ONE_ARG, CALC_CODES_TWO_ARGS, CONDITION_CODES, ENCODINGS, IM1_BIT, IM2_BIT,
+    INSTRUCTION_WORDS, REGISTERS, SUBFUNC_SHIFT, to_u16,
+)
+
+MASK = 0xFFFF
+MEMORY_WORDS = 0x10000
+
+SP = REGISTERS['sp']
+PC = REGISTERS['pc']
+PC_PREV = REGISTERS['pc-']
+PC_NEXT = REGISTERS['pc+']
+# r0-r5, rv, bp and sp are stored; pc, pc- and pc+ are known for every address
+STORED_REGISTERS = SP + 1
+
+# Index of the dispatch table: opcode, type and func bits of w0 without the immediate flags
+DISPATCH_MASK = 0x7FF
+
+
+def dispatch_index(w0: int) -> int:
+    return (w0 >> SUBFUNC_SHIFT) & DISPATCH_MASK
+
+
+def to_signed(x: int) -> int:
+    return x - 0x10000 if x & 0x8000 else x
+
+
+def _shl(a, b):
+    return (a << b) & MASK if b < 16 else 0
+
+
+def _shr(a, b):
+    return a >> b if b < 16 else 0
+
+
+def _rol(a, b):
+    b &= 15
+    return ((a << b) | (a >> (16 - b))) & MASK
+
+
+def _ror(a, b):
+    b &= 15
+    return ((a >> b) | (a << (16 - b))) & MASK
+
+
+# Calculations work on u16 values and return u16 values.
+# Division and modulo by zero give 0.
+CALC_FUNCS = {
+    'not': lambda a: ~a & MASK,
+    'neg': lambda a: -a & MASK,
+    'and': lambda a, b: a & b,
+    'or': lambda a, b: a | b,
+    'nand': lambda a, b: ~(a & b) & MASK,
+    'nor': lambda a, b: ~(a | b) & MASK,
+    'xor': lambda a, b: a ^ b,
+    'xnor': lambda a, b: ~(a ^ b) & MASK,
+    'shl': _shl,
+    'shr': _shr,
+    'rol': _rol,
+    'ror': _ror,
+    'ashr': lambda a, b: (to_signed(a) >> min(b, 15)) & MASK,
+    'add': lambda a, b: (a + b) & MASK,
+    'sub': lambda a, b: (a - b) & MASK,
+    'mul': lambda a, b: (a * b) & MASK,
+    'div': lambda a, b: a // b if b else 0,
+    'mod': lambda a, b: a % b if b else 0,
+}
+
+COND_FUNCS = {
+    'eq': lambda a, b: a == b,
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b,
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+    'lts': lambda a, b: to_signed(a) < to_signed(b),
+    'ltes': lambda a, b: to_signed(a) <= to_signed(b),
+    'gts': lambda a, b: to_signed(a) > to_signed(b),
+    'gtes': lambda a, b: to_signed(a) >= to_signed(b),
+}
+
+# Cycles per executed instruction, by mnemonic. Missing mnemonics cost DEFAULT_CYCLES.
+DEFAULT_CYCLES = 1
+CYCLES = {}
+
+
+class Halt(Exception):
+    pass
+
+
+class Fault(Exception):
+    pass
+
+
+def _build_dispatch() -> list:
+    """Map every dispatch index to (mnemonic, kind) using the encoding table."""
+    table = [None] * (DISPATCH_MASK + 1)
+    for (mnemonic, imm1, imm2), w0 in ENCODINGS.items():
+        if imm1 or imm2:
+            continue
+        if mnemonic in CALC_CODES_ONE_ARG:
+            kind = 'calc1'
+        elif mnemonic in CALC_CODES_TWO_ARGS:
+            kind = 'calc2'
+        elif mnemonic in CONDITION_CODES:
+            kind = 'cond'
+        else:
+            kind = mnemonic
+        table[dispatch_index(w0)] = (mnemonic, kind)
+    return table
+
+
+DISPATCH = _build_dispatch()
+
+
+class Simulator:
+    """
+    Runs an image in the four-word format produced by the assembler.
+    Every instruction is decoded once into a closure that performs it and
+    returns the next pc. Immediates and the pc, pc- and pc+ registers of an
+    instruction are known at decode time, so they live in constant slots after
+    the stored registers and every operand is a plain index into regs.
+    The stack memory is separate from the program, push decrements sp first.
+    data lists (first slot, slots) of data directives; running into them faults.
+    """
+
+    def __init__(self, image, cycle_costs: dict | None = None, data=()):
+        if len(image) % INSTRUCTION_WORDS:
+            raise ValueError(f"Image size {len(image)} is not a multiple of {INSTRUCTION_WORDS} words")
+        self.image = image
+        self.cycle_costs = CYCLES if cycle_costs is None else cycle_costs
+        self.regs = [0] * STORED_REGISTERS
+        self.memory = array('H', bytes(2 * MEMORY_WORDS))
+        self.pc = 0
+        self.steps = 0
+        self.cycles = 0
+        self.counts = None
+        self._constants = {}
+        self.mnemonics = []
+        self.code = [self._decode(i) for i in range(len(image) // INSTRUCTION_WORDS)]
+        for start, slots in data:
+            for address in range(start, start + slots):
+                self.mnemonics[address] = None
+                self.code[address] = self._fault(f"{address}: pc is in data")
+
+    def _constant(self, value: int) -> int:
+        slot = self._constants.get(value)
+        if slot is None:
+            slot = self._constants[value] = len(self.regs)
+            self.regs.append(value)
+        return slot
+
+    def _source(self, address: int, value: int, immediate: bool) -> int:
+        if immediate:
+            return self._constant(value)
+        if value == PC:
+            return self._constant(to_u16(address + 1))
+        if value == PC_PREV:
+            return self._constant(address)
+        if value == PC_NEXT:
+            return self._constant(to_u16(address + 2))
+        if value >= STORED_REGISTERS:
+            raise Fault(f"{address}: unknown register {value}")
+        return value
+
+    @staticmethod
+    def _destination(address: int, value: int) -> int:
+        if value > PC:
+            raise Fault(f"{address}: register {value} can not be a destination")
+        return value
+
+    def _decode(self, address: int):
+        start = address * INSTRUCTION_WORDS
+        w0, arg1, arg2, dst = self.image[start:start + INSTRUCTION_WORDS]
+        entry = DISPATCH[dispatch_index(w0)]
+        if entry is None:
+            self.mnemonics.append(None)
+            return self._fault(f"{address}: unknown instruction word {w0}")
+        mnemonic, kind = entry
+        self.mnemonics.append(mnemonic)
+        try:
+            return self._build(address, kind, mnemonic, w0, arg1, arg2, dst)
+        except Fault as e:
+            return self._fault(str(e))
+
+    @staticmethod
+    def _fault(message: str):
+        def step():
+            raise Fault(message)
+        return step
+
+    def _build(self, address, kind, mnemonic, w0, arg1, arg2, dst):
+        regs = self.regs
+        memory = self.memory
+        nxt = address + 1
+        imm1 = bool(w0 >> IM1_BIT & 1)
+        imm2 = bool(w0 >> IM2_BIT & 1)
+
+        if kind == 'nop':
+            return lambda: nxt
+
+        if kind == 'exit':
+            def step():
+                raise Halt()
+            return step
+
+        if kind == 'cond':
+            fn = COND_FUNCS[mnemonic]
+            a = self._source(address, arg1, imm1)
+            b = self._source(address, arg2, imm2)
+            target = dst
+            return lambda: target if fn(regs[a], regs[b]) else nxt
+
+        if kind == 'push':
+            a = self._source(address, arg1, imm1)
+
+            def step():
+                value = regs[a]
+                sp = regs[SP] = (regs[SP] - 1) & MASK
+                memory[sp] = value
+                return nxt
+            return step
+
+        d = self._destination(address, dst)
+
+        if kind == 'pop':
+            if d == PC:
+                def step():
+                    sp = regs[SP]
+                    regs[SP] = (sp + 1) & MASK
+                    return memory[sp]
+            else:
+                def step():
+                    sp = regs[SP]
+                    regs[SP] = (sp + 1) & MASK
+                    regs[d] = memory[sp]
+                    return nxt
+            return step
+
+        a = self._source(address, arg1, imm1)
+
+        if kind == 'mov':
+            if d == PC:
+                return lambda: regs[a]
+
+            def step():
+                regs[d] = regs[a]
+                return nxt
+            return step
+
+        fn = CALC_FUNCS[mnemonic]
+        if kind == 'calc1':
+            if d == PC:
+                return lambda: fn(regs[a])
+
+            def step():
+                regs[d] = fn(regs[a])
+                return nxt
+            return step
+
+        b = self._source(address, arg2, imm2)
+        if d == PC:
+            return lambda: fn(regs[a], regs[b])
+
+        def step():
+            regs[d] = fn(regs[a], regs[b])
+            return nxt
+        return step
+
+    def register(self, name: str) -> int:
+        return self.regs[REGISTERS[name]]
+
+    def run(self, max_steps: int = 100_000_000, profile: bool = False) -> dict:
+        """
+        Run from the current pc until exit, a fault or max_steps.
+        With profile, or with non-uniform cycle costs, every address counts
+        its executions in self.counts, which makes the run slower.
+        """
+        costs = set(self.cycle_costs.get(m, DEFAULT_CYCLES) for m in self.mnemonics if m is not None)
+        uniform = len(costs) <= 1
+        if profile or not uniform:
+            if self.counts is None:
+                self.counts = [0] * len(self.code)
+
+        code = self.code
+        counts = self.counts
+        pc = self.pc
+        steps = 0
+        status = 'max_steps'
+        message = None
+        started = time.perf_counter()
+        try:
+            if counts is None:
+                for steps in range(1, max_steps + 1):
+                    pc = code[pc]()
+            else:
+                for steps in range(1, max_steps + 1):
+                    counts[pc] += 1
+                    pc = code[pc]()
+        except Halt:
+            status = 'exit'
+        except Fault as e:
+            status = 'fault'
+            message = str(e)
+        except IndexError:
+            status = 'fault'
+            message = f"pc {pc} is outside of the program"
+            steps -= 1
+        elapsed = time.perf_counter() - started
+
+        self.pc = pc
+        self.steps += steps
+        if counts is None:
+            self.cycles += steps * (costs.pop() if costs else DEFAULT_CYCLES)
+        else:
+            self.cycles = sum(
+                count * self.cycle_costs.get(mnemonic, DEFAULT_CYCLES)
+                for count, mnemonic in zip(counts, self.mnemonics) if count
+            )
+
+        return {
+            'status': status,
+            'message': message,
+            'pc': pc,
+            'steps': self.steps,
+            'cycles': self.cycles,
+            'seconds': elapsed,
+            'registers': {name: self.regs[index] for name, index in REGISTERS.items() if index < STORED_REGISTERS},
+        }
+
+
+def load(path: str) -> array:
+    """Load an image written in the text or the binary format."""
+    with open(path, 'rb') as fin:
+        head = fin.read(2)
+
+    if path.endswith('.bin') or int.from_bytes(head, 'little') == MAGIC:
+        with RomImage(path) as rom:
+            return array('H', rom.words)
+
+    with open(path, 'r', encoding='utf-8') as fin:
+        return array('H', (int(word) for word in fin.read().split()))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run an assembled image.")
+    parser.add_argument('image', help="output file in the text or the binary format")
+    parser.add_argument('--max-steps', type=int, default=100_000_000)
+    parser.add_argument('--profile', action='store_true', help="count executions of every address")
+    parser.add_argument('--top', type=int, default=10, help="hottest addresses to print with --profile")
+    parser.add_argument('--source-map',
+                        help="source map of the image: shows source lines with --profile, faults on running into data")
+    args = parser.parse_args(argv)
+
+    source_map = SourceMap.load(args.source_map) if args.source_map else None
+    simulator = Simulator(load(args.image), data=source_map.data_ranges if source_map is not None else ())
+    result = simulator.run(args.max_steps, args.profile)
+
+    print(f"status: {result['status']}" + (f" ({result['message']})" if result['message'] else ''))
+    print(f"pc: {result['pc']}")
+    print(' '.join(f"{name}={value}" for name, value in result['registers'].items()))
+    rate = result['steps'] / result['seconds'] if result['seconds'] else 0
+    print(f"steps: {result['steps']}  cycles: {result['cycles']}  {rate / 1e6:.2f} M steps/s")
+
+    if simulator.counts is not None:
+        hot = sorted(range(len(simulator.counts)), key=lambda i: -simulator.counts[i])[:args.top]
+        for address in hot:
+            if simulator.counts[address]:
+                where = ''
+                if source_map is not None and source_map.lookup(address) is not None:
+                    file, line, macro, label = source_map.lookup(address)
+                    where = f"  {file}:{line}" + (f" {macro} {label}" if macro else '')
+                print(f"{address:6} {simulator.mnemonics[address] or '?':6} {simulator.counts[address]}{where}")
+
+    return 0 if result['status'] == 'exit' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
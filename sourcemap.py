@@ -0,0 +1,71 @@
+import json
+from bisect import bisect_right
+
+# Source map: runs of consecutive addresses that came from the same source
+# line, as parallel arrays sorted by the first address of each run, so an
+# address is found with one binary search.
+SOURCE_MAP_FORMAT = 'tc-source-map'
+SOURCE_MAP_VERSION = 1
+
+
+def build_source_map(lines, macros: dict, labels: dict, file: str = '', data=()) -> dict:
+    """
+    lines holds the source line of every instruction, macros maps a source
+    line to (macro, system label) for lines the macro expander expanded,
+    data lists (first slot, slots) of the data directives.
+    """
+    starts, run_lines, run_macros, run_labels = [], [], [], []
+    previous = None
+    for address, ln in enumerate(lines):
+        if ln == previous:
+            continue
+        previous = ln
+        macro, label = macros.get(ln, (None, None))
+        starts.append(address)
+        run_lines.append(ln)
+        run_macros.append(macro)
+        run_labels.append(label)
+    return {
+        'format': SOURCE_MAP_FORMAT,
+        'version': SOURCE_MAP_VERSION,
+        'file': file,
+        'size': len(lines),
+        'starts': starts,
+        'lines': run_lines,
+        'macros': run_macros,
+        'labels': run_labels,
+        'symbols': labels,
+        'data': [list(data_range) for data_range in data],
+    }
+
+
+def write_source_map(path: str, source_map: dict):
+    with open(path, 'w', encoding='utf-8') as fout:
+        json.dump(source_map, fout, separators=(',', ':'))
+
+
+class SourceMap:
+    """Lookups in a source map written by write_source_map."""
+
+    def __init__(self, data: dict):
+        if data.get('format') != SOURCE_MAP_FORMAT or data.get('version') != SOURCE_MAP_VERSION:
+            raise ValueError(f"not a version {SOURCE_MAP_VERSION} source map")
+        self.data = data
+        self.file = data['file']
+        self.size = data['size']
+        self.starts = data['starts']
+        self.symbols = data['symbols']
+        # Maps written before data directives have no data ranges
+        self.data_ranges = [tuple(data_range) for data_range in data.get('data', [])]
+
+    @classmethod
+    def load(cls, path: str) -> 'SourceMap':
+        with open(path, 'r', encoding='utf-8') as fin:
+            return cls(json.load(fin))
+
+    def lookup(self, address: int) -> tuple[str, int, str | None, str | None] | None:
+        """(file, line, macro, system label) of the instruction at address, None outside the program."""
+        if not 0 <= address < self.size:
+            return None
+        run = bisect_right(self.starts, address) - 1
+        return self.file, self.data['lines'][run], self.data['macros'][run], self.data['labels'][run]
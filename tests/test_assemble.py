@@ -0,0 +1,55 @@
+from assemble import Assembler
+
+
+def messages(source: str, **options) -> list[str]:
+    assembler = Assembler(**options)
+    assembler.assemble(source.splitlines(True))
+    return assembler.messages
+
+
+def test_duplicate_label_is_a_positioned_error():
+    result = messages("label a\nlabel a\nfoo\nexit\n")
+    assert result[0].startswith("Error while assemble: 2: Label a already in labels")
+    assert result[1] == "Error while assemble: 3: Unknown opcode 'foo'"
+
+
+def test_second_else_is_a_positioned_error():
+    result = messages("if eq r0 0\nmov 1 r1\nelse\nmov 2 r1\nelse\nmov 3 r1\nend\nexit\n")
+    assert result == ["Error while unpack macro: 5: 'else'"]
+
+
+def test_duplicate_label_across_cached_functions(tmp_path):
+    from cache import BuildCache
+    source = "call f\nexit\ndef f\nmov 1 rv\nret rv\ndef f\nmov 2 rv\nret rv\n"
+    for cache in (None, BuildCache(str(tmp_path))):
+        assembler = Assembler()
+        assembler.assemble(source.splitlines(True), cache=cache)
+        assert assembler.messages == ["Error while assemble: 6: Label f already in labels. Each label should appear once."]
+
+
+def test_cached_function_keeps_its_source_lines():
+    from cache import BuildCache
+    cache = BuildCache()
+    Assembler().assemble("call f\nexit\ndef f\nmov 1 rv\nret rv\n".splitlines(True), cache=cache)
+    source = "call f\nexit\ndef f\n; one more line\nmov 1 rv\nret rv\n".splitlines(True)
+    assembler = Assembler()
+    assembler.assemble(source, cache=cache)
+    fresh = Assembler()
+    fresh.assemble(source)
+    assert list(assembler.lines) == list(fresh.lines)
+
+
+def test_rebuild_changes_only_the_edited_function():
+    from cache import BuildCache
+    program = "call f\ncall g\nexit\ndef f\n  mov 1 rv\n{body}  ret rv\ndef g\n  label loop\n  jmp loop\n  ret rv\n"
+    cache = BuildCache()
+    Assembler().assemble(program.format(body="").splitlines(True), cache=cache)
+    source = program.format(body="  add rv 2 rv\n").splitlines(True)
+    assembler = Assembler()
+    image = assembler.assemble(source, cache=cache)
+    fresh = Assembler()
+    assert list(image) == list(fresh.assemble(source, cache=BuildCache()))
+    assert assembler.changed_blocks == 1
+    assert assembler.labels == fresh.labels
+    assert list(assembler.lines) == list(fresh.lines)
+    assert assembler.render_text() == fresh.render_text()
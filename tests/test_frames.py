@@ -0,0 +1,89 @@
+import pytest
+
+from assemble import Assembler
+from simulator import Simulator
+
+PRELUDE = "mov 1234 bp\nmov 301 r3\nmov 302 r4\nmov 303 r5\n"
+
+# Functions that need their frame: it must stay whether or not frames are omitted
+FRAMED = {
+    'uses bp': """
+call f
+exit
+def f
+  add bp 0 rv
+  ret rv
+""",
+    'reserves stack': """
+call f
+exit
+def f reserve 3
+  mov sp r0
+  push 9
+  pop r1
+  sub bp r0 rv
+  ret rv
+""",
+    'stack args': """
+call f args 5 6
+exit
+def f args 2 save r3
+  mov bp r3
+  add r3 2 r3
+  sub r3 sp rv
+  ret rv
+""",
+}
+
+# Leaf and calling functions that never name bp or sp
+FRAMELESS = {
+    'leaf': """
+mov 3 r0
+call f
+exit
+def f
+  add r0 r0 rv
+  ret rv
+""",
+    'calls': """
+call f args 2
+exit
+def f args 1 save r4
+  mov 5 r4
+  call g
+  add rv r4 rv
+  ret rv
+def g
+  mov 6 rv
+  ret rv
+""",
+}
+
+CHECKED = ('r3', 'r4', 'r5', 'bp', 'sp', 'rv')
+
+
+def run(source: str, **options) -> tuple[dict, int]:
+    assembler = Assembler(**options)
+    image = assembler.assemble((PRELUDE + source).splitlines(True))
+    assert not assembler.messages
+    result = Simulator(image).run(10_000)
+    assert result['status'] == 'exit'
+    return result['registers'], len(image)
+
+
+@pytest.mark.parametrize('name', FRAMED)
+def test_framed_functions_keep_their_frame(name):
+    kept, kept_size = run(FRAMED[name], omit_frame_pointer=False)
+    omitted, omitted_size = run(FRAMED[name], omit_frame_pointer=True)
+    assert {r: omitted[r] for r in CHECKED} == {r: kept[r] for r in CHECKED}
+    assert (kept['r3'], kept['r4'], kept['r5'], kept['bp'], kept['sp']) == (301, 302, 303, 1234, 0)
+    assert omitted_size == kept_size
+
+
+@pytest.mark.parametrize('name', FRAMELESS)
+def test_frameless_functions_drop_their_frame(name):
+    kept, kept_size = run(FRAMELESS[name], omit_frame_pointer=False)
+    omitted, omitted_size = run(FRAMELESS[name], omit_frame_pointer=True)
+    assert {r: omitted[r] for r in CHECKED} == {r: kept[r] for r in CHECKED}
+    assert (kept['r3'], kept['r4'], kept['r5'], kept['bp'], kept['sp']) == (301, 302, 303, 1234, 0)
+    assert omitted_size < kept_size
@@ -0,0 +1,31 @@
+from array import array
+
+import pytest
+
+import image
+from image import RomImage, pack_image, write_image
+
+CODE = array('H', range(8))
+LABELS = {'start': 0, 'loop_end': 1, 'abc': 1}
+
+
+def test_label_table_round_trip(tmp_path):
+    path = tmp_path / 'prog.bin'
+    write_image(str(path), CODE, header=True, labels=LABELS)
+    with RomImage(str(path)) as rom:
+        assert rom.labels == LABELS
+        assert list(rom.words) == list(CODE)
+
+
+def test_label_names_are_not_byteswapped(monkeypatch):
+    # On a big-endian host every number of the table is swapped, the names stay as they are
+    monkeypatch.setattr(image, 'LITTLE_ENDIAN', False)
+    packed = pack_image(CODE, header=True, labels=LABELS)
+    for name in LABELS:
+        assert name.encode('utf-8') in packed
+
+
+def test_label_count_must_fit_in_a_word():
+    labels = {f"l{i}": 0 for i in range(0x10000)}
+    with pytest.raises(ValueError, match="do not fit"):
+        pack_image(CODE, header=True, labels=labels)
@@ -0,0 +1,15 @@
+from assemble import Assembler
+from lexer import number
+
+
+def test_number_follows_python_literals():
+    for tok in ['0', '00', '42', '-7', '+7', '0x_ff', '0XFF', '0o17', '0b1_0', '1_000', '-0b1']:
+        assert number(tok) == int(tok, 0)
+    for tok in ['010', '-09', '1__0', '1_', '_1', '0x', '0x__f', '0b2', '1e3', '--1', '']:
+        assert number(tok) is None
+
+
+def test_def_operands_take_any_number():
+    assembler = Assembler()
+    assembler.assemble("def f reserve 0x2 args 0b1\nmov 1 rv\nret rv\nexit\n".splitlines(True))
+    assert not assembler.messages
@@ -0,0 +1,24 @@
+from array import array
+
+from link import assemble_object, link
+from main import ADDRESS_SPACE, INSTRUCTION_WORDS
+from simulator import Simulator
+
+
+def test_link_resolves_symbols_across_modules():
+    main, messages = assemble_object(["call f", "mov rv r3", "exit"], 'main')
+    assert not messages
+    lib, messages = assemble_object(["def f", "mov 42 rv", "ret rv"], 'lib')
+    assert not messages
+    image, symbols, messages = link([main, lib])
+    assert not messages
+    assert Simulator(image).run(100)['registers']['r3'] == 42
+
+
+def test_link_reports_images_beyond_the_address_space():
+    half = ADDRESS_SPACE // 2 + 1
+    big = {'name': 'big', 'words': array('H', [0] * half * INSTRUCTION_WORDS), 'symbols': {}, 'relocations': []}
+    tail = {'name': 'tail', 'words': array('H', [0] * INSTRUCTION_WORDS), 'symbols': {'end': 0},
+            'relocations': [(0, 1, 'end', 1)]}
+    _, _, messages = link([big, dict(big, name='big2'), tail])
+    assert messages == [f"Error while link: {2 * half + 1} instructions do not fit in {ADDRESS_SPACE} addresses"]
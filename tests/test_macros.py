@@ -0,0 +1,17 @@
+from assemble import Assembler
+
+
+def test_elif_without_if_is_an_error():
+    for source in ["elif eq r0 0\nexit\n", "for r0 0 3\nelif eq r0 0\nend\nexit\n"]:
+        assembler = Assembler()
+        assembler.assemble(source.splitlines(True))
+        assert "elif without if" in assembler.messages[0]
+
+
+def test_bad_def_operand_is_one_error():
+    for source in ["def f reserve x\nmov 1 rv\nret rv\nexit\n",
+                   "def f args 2 args 3 save auto\nmov 1 r3\nret rv\nexit\n"]:
+        assembler = Assembler()
+        assembler.assemble(source.splitlines(True))
+        assert len(assembler.messages) == 1
+        assert assembler.messages[0].startswith("Error while unpack macro: 1:")
@@ -0,0 +1,26 @@
+from assemble import Assembler
+from peephole import PeepholeOptimizer
+
+
+def test_bare_label_is_an_assembler_error():
+    for source in ["jmp x\nlabel\nexit\n", "eq r0 r1 x\njmp y\nlabel\nexit\n"]:
+        plain = Assembler()
+        plain.assemble(source.splitlines(True))
+        optimized = Assembler(optimize=True)
+        optimized.assemble(source.splitlines(True))
+        assert optimized.messages == plain.messages
+        assert "label expects 1 operands" in optimized.messages[0]
+
+
+def test_division_by_zero_is_not_folded():
+    optimizer = PeepholeOptimizer()
+    lines = [(1, "div 7 0 r0"), (2, "mod 7 0 r1"), (3, "div 7 2 r2")]
+    assert list(optimizer.optimize(lines)) == [(1, "div 7 0 r0"), (2, "mod 7 0 r1"), (3, "mov 3 r2")]
+
+
+def test_shifts_fold_only_by_0_to_15():
+    optimizer = PeepholeOptimizer()
+    lines = [(1, "shl 1 15 r0"), (2, "shl 1 20 r0"), (3, "shr 4 16 r1"), (4, "rol 1 0 r2"), (5, "ashr 8 99 r3")]
+    assert list(optimizer.optimize(lines)) == [
+        (1, "mov 32768 r0"), (2, "shl 1 20 r0"), (3, "shr 4 16 r1"), (4, "mov 1 r2"), (5, "ashr 8 99 r3"),
+    ]
@@ -0,0 +1,131 @@
+from assemble import Assembler
+from clean import clean_lines
+from simulator import Simulator
+from unpack_macro import MacroExpander
+
+
+def pushes(source: str) -> dict[int, list[str]]:
+    """Registers pushed by the expansion of every source line, without 'push pc+' and arguments."""
+    messages = []
+    result = {}
+    for ln, line in MacroExpander().unpack_macro_lines(clean_lines(source.splitlines(True)), messages):
+        parts = line.split()
+        if parts[0] == 'push' and parts[1] in ('r0', 'r1', 'r2', 'r3', 'r4', 'r5'):
+            result.setdefault(ln, []).append(parts[1])
+    assert not messages
+    return result
+
+
+def run(source: str) -> dict:
+    assembler = Assembler()
+    image = assembler.assemble(source.splitlines(True))
+    assert not assembler.messages
+    result = Simulator(image).run(100_000)
+    assert result['status'] == 'exit'
+    return result['registers']
+
+
+CLOBBER = """
+def g
+  mov 0 r0
+  mov 0 r1
+  mov 0 r2
+  ret rv
+"""
+
+BRANCHES = """mov 1 r0
+mov 2 r1
+mov 3 r2
+if eq r0 1
+  call g save auto
+  add r1 0 r4
+else
+  call g save auto
+end
+add r0 0 r5
+exit
+""" + CLOBBER
+
+# In a function the loop is inside the region, and g comes first, so its
+# summary (it reads nothing but rv) is known at the call
+LOOP = """call h
+exit""" + CLOBBER + """def h
+  mov 0 rv
+  mov 5 r2
+  for r0 0 3
+    call g save auto
+    add rv r2 rv
+  end
+  mov 0 r1
+  ret rv
+"""
+
+CALLEE = """mov 301 r3
+mov 302 r4
+mov 303 r5
+mov 1 r0
+call f
+exit
+def f save auto
+  if eq r0 1
+    mov 7 r3
+  else
+    mov 8 r4
+  end
+  for r5 0 2
+    mov 1 r1
+  end
+  add r3 r5 rv
+  ret rv
+"""
+
+
+def test_call_saves_registers_live_on_its_branch():
+    # r1 is only read after the call on the true branch, r2 never again
+    assert pushes(BRANCHES) == {5: ['r0', 'r1'], 8: ['r0']}
+    registers = run(BRANCHES)
+    assert (registers['r4'], registers['r5']) == (2, 1)
+
+
+def test_call_in_loop_saves_loop_state():
+    # The loop counter r0 and r2 are read after the call; r1 is written before any read
+    saved = pushes(LOOP)
+    assert saved == {12: ['r0', 'r2']}
+    registers = run(LOOP)
+    assert registers['rv'] == 15
+
+
+def test_def_saves_the_callee_saved_registers_it_writes():
+    # Both branches count, r5 is the loop counter; r1 is caller-saved
+    assert pushes(CALLEE) == {7: ['r3', 'r4', 'r5']}
+    registers = run(CALLEE)
+    assert (registers['r3'], registers['r4'], registers['r5'], registers['rv']) == (301, 302, 303, 9)
+
+
+def test_cached_summaries_follow_their_callees():
+    from cache import BuildCache
+    # mid has no automatic saves, but its summary, which caller reads, follows leaf
+    program = """mov 7 r1
+call caller
+mov rv r3
+exit
+def leaf
+  {leaf}
+  ret rv
+def mid
+  call leaf
+  add rv 1 rv
+  ret rv
+def caller save auto
+  call g save auto
+  call mid save auto
+  add rv 1 rv
+  ret rv
+""" + CLOBBER
+    cache = BuildCache()
+    Assembler().assemble(program.format(leaf="mov 5 rv").splitlines(True), cache=cache)
+    source = program.format(leaf="mov r1 rv").splitlines(True)
+    cached = Assembler()
+    image = cached.assemble(source, cache=cache)
+    assert list(image) == list(Assembler().assemble(source, cache=BuildCache()))
+    assert Simulator(image).run(100_000)['registers']['r3'] == 9
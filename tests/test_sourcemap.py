@@ -0,0 +1,31 @@
+import simulator
+from assemble import Assembler
+from main import render_text
+from sourcemap import SourceMap, write_source_map
+
+PROGRAM = """
+for r0 0 3
+  add r1 r0 r1
+end
+exit
+label table
+words 1 2 3 4 5
+string "ab"
+"""
+
+
+def test_profile_with_data_ranges(tmp_path, capsys):
+    assembler = Assembler()
+    image = assembler.assemble(PROGRAM.splitlines(True))
+    assert not assembler.messages
+    image_path = tmp_path / 'prog.out.txt'
+    map_path = tmp_path / 'prog.map.json'
+    image_path.write_text(render_text(image), encoding='utf-8')
+    write_source_map(str(map_path), assembler.source_map('prog.asm'))
+
+    source_map = SourceMap.load(str(map_path))
+    assert source_map.data_ranges == assembler.data
+    assert source_map.lookup(0)[:2] == ('prog.asm', 2)
+
+    assert simulator.main([str(image_path), '--profile', '--source-map', str(map_path)]) == 0
+    assert 'prog.asm:3' in capsys.readouterr().out
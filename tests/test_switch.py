@@ -0,0 +1,36 @@
+from assemble import Assembler
+from simulator import Simulator
+
+# The table starts at 6: entries of consecutive values jump to adjacent restore stubs
+OFFSET_TABLE = """
+mov 8 r0
+mov 0 r1
+switch r0
+case 9 8 7
+mov 1 r1
+case 6
+mov 2 r1
+default
+mov 999 r1
+end
+exit
+"""
+
+
+def run(source: str, **options) -> dict:
+    assembler = Assembler(**options)
+    image = assembler.assemble(source.splitlines(True))
+    assert not assembler.messages
+    result = Simulator(image).run(1000)
+    assert result['status'] == 'exit'
+    return result['registers']
+
+
+def test_offset_table_restores_register():
+    registers = run(OFFSET_TABLE)
+    assert (registers['r0'], registers['r1']) == (8, 1)
+
+
+def test_peephole_keeps_table_entries():
+    registers = run(OFFSET_TABLE, optimize=True)
+    assert (registers['r0'], registers['r1']) == (8, 1)
@@ -0,0 +1,102 @@
+import pytest
+
+from assemble import Assembler
+from simulator import Simulator
+
+PRELUDE = "mov 301 r3\nmov 302 r4\nmov 303 r5\n"
+
+PROGRAMS = {
+    'plain': """
+call f
+exit
+def f
+  mov 4 r0
+  call g
+  ret rv
+def g
+  add r0 1 rv
+  ret rv
+""",
+    'save': """
+call f
+exit
+def f save r3 r4
+  mov 7 r3
+  mov 8 r4
+  add r3 r4 r0
+  call g
+  ret rv
+def g save r5
+  mov 9 r5
+  add r0 r5 rv
+  ret rv
+""",
+    'args': """
+call f args 1 2
+exit
+def f args 2
+  mov 5 r1
+  call g args r1 6
+  ret rv
+def g args 2
+  mov 11 rv
+  ret rv
+""",
+    'save auto': """
+mov 10 r0
+call count
+exit
+def count save auto
+  mov r0 r3
+  if eq r0 0
+    mov 0 rv
+  else
+    sub r0 1 r0
+    call count
+  end
+  ret rv
+""",
+    'recursion with args': """
+mov 500 r0
+call down args 500
+exit
+def down args 1
+  if eq r0 0
+    mov 77 rv
+  else
+    sub r0 1 r0
+    call down args r0
+  end
+  ret rv
+""",
+}
+
+CHECKED = ('r3', 'r4', 'r5', 'sp', 'rv')
+
+
+def run(source: str, **options) -> tuple[dict, int, list]:
+    assembler = Assembler(**options)
+    image = assembler.assemble((PRELUDE + source).splitlines(True))
+    assert not assembler.messages
+    result = Simulator(image).run(1_000_000)
+    assert result['status'] == 'exit'
+    return result['registers'], result['steps'], list(image)
+
+
+@pytest.mark.parametrize('name', PROGRAMS)
+def test_tail_calls_keep_registers_and_stack(name):
+    plain, plain_steps, plain_image = run(PROGRAMS[name], tail_calls=False)
+    tail, tail_steps, tail_image = run(PROGRAMS[name], tail_calls=True)
+    assert {r: tail[r] for r in CHECKED} == {r: plain[r] for r in CHECKED}
+    assert (plain['r3'], plain['r4'], plain['r5'], plain['sp']) == (301, 302, 303, 0)
+    # Every program has a tail call, and it saves work
+    assert tail_image != plain_image
+    assert tail_steps < plain_steps
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_tail_call_results(optimize):
+    expected = {'plain': 5, 'save': 24, 'args': 11, 'save auto': 0, 'recursion with args': 77}
+    for name, source in PROGRAMS.items():
+        registers, _, _ = run(source, optimize=optimize)
+        assert registers['rv'] == expected[name], name
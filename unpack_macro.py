@@ -1,330 +1,954 @@
 from queue import LifoQueue
 
+import liveness
 from errors import MESSAGES
-from utils import is_condition
+from lexer import number, tokenize
+from liveness import RESTORE_MARKER, SAVE_MARKER
+from main import DATA_DIRECTIVES, to_u16
+from utils import INVERSE_CONDITIONS, is_condition, is_register
 
 
 CALLER_SAVED = ['r0', 'r1', 'r2']
 CALLEE_SAVED = ['r3', 'r4', 'r5']
 
-global_function = {
-    'is_inside': False,
-    'args_quantity': 0,
-    'saved_registers': [],
+MACROS = {'def', 'ret', 'call', 'if', 'elif', 'else', 'for', 'while', 'switch', 'case', 'default', 'end'}
+
+# Placeholders around calls and before 'ret rv', used to find tail calls in a function
+CALL_MARKER = '.call'
+CALLED_MARKER = '.called'
+RETURN_MARKER = '.ret'
+# Placeholder for the frame pointer setup ('.frame enter') and teardown ('.frame leave')
+FRAME_MARKER = '.frame'
+FRAME_CODE = {
+    'enter': ["push bp", "mov sp bp"],
+    'leave': ["pop bp"],
 }
+# Registers whose use in a function body keeps its frame
+FRAME_REGISTERS = {'bp', 'sp'}
+# Macros that open a block closed by 'end'
+BLOCK_MACROS = {'if', 'for', 'while', 'switch'}
+# A switch jumps through a table when it has at least SWITCH_TABLE_MIN values
+# and at most SWITCH_DENSITY table entries per value, otherwise it searches
+SWITCH_TABLE_MIN = 4
+SWITCH_DENSITY = 2
+# Values at the leaves of the search, compared one by one
+SWITCH_LINEAR = 3
+# Registers a computed jump can not go through
+PC_REGISTERS = {'pc', 'pc-', 'pc+'}
+
+
+class MacroExpander:
+    """
+    Macro state of one compilation: the open function, open blocks and system labels.
+
+    With rotate_loops, for and while test their condition at the bottom of the
+    loop, jumping straight back into the body, after a guard on entry. An
+    iteration then costs one branch instead of a test, a jump over the exit
+    jump and a jump back to the top.
+
+    'save auto' in def and call leaves the choice of saved registers to a
+    liveness analysis. Function bodies, and top-level code from its first
+    automatic call up to the next def, are held back as a region until the
+    analysis can run over the whole of it.
+
+    With tail_calls, a call in a function from which control reaches 'ret rv'
+    with nothing but labels and jumps in between unwinds the frame first and
+    jumps to the callee, which then returns straight to our caller.
+
+    With omit_frame_pointer, a function that reserves no locals and never
+    names bp or sp does without 'push bp', 'mov sp bp' and 'pop bp': nothing
+    in it can depend on bp or on where its arguments sit relative to sp.
+
+    A call of a function recorded in inline by collect_inline is replaced by
+    the body of the function. The definitions of 'inline def' functions are
+    skipped where they stand.
+    """
+
+    def __init__(self, rotate_loops: bool = True, tail_calls: bool = True, omit_frame_pointer: bool = True):
+        self.rotate_loops = rotate_loops
+        self.tail_calls = tail_calls
+        self.omit_frame_pointer = omit_frame_pointer
+        self.global_function = {
+            'is_inside': False,
+            'name': None,
+            'args_quantity': 0,
+            'stack_args': None,
+            'saved_registers': [],
+            'auto_save': False,
+            'uses_frame': False,
+            'free_sys_label': 0,
+        }
+        self.nests = LifoQueue()
+        self.free_sys_label = 0
+        # Registers every analysed function reads on entry, as liveness bit masks
+        self.summaries = {}
+        self.region = None
+        self.region_function = None
+        self.region_frame = None
+        self.region_closed = False
+        self.free_save_marker = 0
+        self.calls = {}
+        # Source line number -> (macro, system label or function) of every expanded macro
+        self.macros = {}
+        # Inline functions by name, see collect_inline
+        self.inline = {}
+        self.inlining = []
+        self.skipping_inline = False
+        # Registers an inlined body writes, by the marker of its 'save auto'
+        self.save_masks = {}
+        # Function name -> [calls inlined, instructions of call overhead removed]
+        self.inlined = {}
+
+    def get_free_sys_label(self):
+        """
+        Labels inside a function are namespaced by its name and numbered from 0
+        in every function, so a function expands the same wherever it stands.
+        """
+        if self.global_function['is_inside']:
+            result = f"___{self.global_function['name']}_{self.global_function['free_sys_label']}"
+            self.global_function['free_sys_label'] += 1
+            return result
+        result = "___" + str(self.free_sys_label)
+        self.free_sys_label += 1
+        return result
+
+    @staticmethod
+    def tail_call(call: dict, frame: dict) -> list[str] | None:
+        """
+        Code that replaces 'pop pc' after the epilogue to make call a tail call,
+        or None if the callee can not take over the frame. Without arguments the
+        callee returns to our caller, which drops our arguments as before. With
+        arguments they replace ours, so the function must declare 'args N' with
+        the same count, and no argument may be a register the epilogue changes.
+        """
+        target, args = call['target'], call['args']
+        changed = {'rv', 'bp', 'sp', 'pc', 'pc-', 'pc+'}
+        changed.update(frame['saved_registers'])
+        if frame['auto_save']:
+            changed.update(CALLEE_SAVED)
+        if target in changed or (is_register(target) and target not in CALLER_SAVED):
+            return None
+        if not args:
+            return [f"jmp {target}"]
+        if frame['stack_args'] != len(args) or changed.intersection(args):
+            return None
+
+        code = [
+            "pop rv",
+            f"add sp {len(args)} sp",
+        ]
+        for arg in reversed(args):
+            code.append(f'push {arg}')
+        code.append("push rv")
+        code.append(f"jmp {target}")
+        return code
+
+    def process_line(self, line: str) -> list[str]:
+        parts = tokenize(line)
+        op = parts[0]
+        if self.global_function['is_inside'] and not FRAME_REGISTERS.isdisjoint(parts):
+            self.global_function['uses_frame'] = True
+
+        match op:
+            case "def":
+                if self.global_function['is_inside']:
+                    raise ValueError()
 
-nests = LifoQueue()
-free_sys_label = 0
-
-
-def get_free_sys_label():
-    global free_sys_label
-    result = "___" + str(free_sys_label)
-    free_sys_label += 1
-    return result
-
-
-def code_to_str(code: list) -> str:
-    result = ""
-    for line in code:
-        result = result + line + "\n"
-    return result
-
+                if not self.nests.empty():
+                    raise ValueError()
 
-def process_line(line: str) -> str:
-    parts = line.split()
-    op = parts[0]
+                if len(parts) == 1:
+                    raise ValueError()
 
-    match op:
-        case "def":
-            if global_function['is_inside']:
-                raise ValueError()
+                # The function and its region are open even if an operand is wrong,
+                # so its ret closes them without a second error
+                self.global_function['is_inside'] = True
+                self.global_function['name'] = parts[1]
+                self.region = []
+                self.region_function = parts[1]
+
+                saved_registers = []
+                auto_save = False
+                args_quantity = 0
+                stack_args = None
+                mode = None
+                for tok in parts[2:]:
+                    if tok in ("save", "reserve", "args"):
+                        mode = tok
+                    elif mode == "save":
+                        if tok == "auto":
+                            auto_save = True
+                        elif tok in CALLEE_SAVED:
+                            saved_registers.append(tok)
+                        else:
+                            raise ValueError()
+                    elif mode == "reserve":
+                        if not args_quantity:
+                            args_quantity = number(tok)
+                            if args_quantity is None:
+                                raise ValueError()
+                        else:
+                            raise ValueError()
+                    elif mode == "args":
+                        if stack_args is None:
+                            stack_args = number(tok)
+                            if stack_args is None:
+                                raise ValueError()
+                        else:
+                            raise ValueError()
+                    else:
+                        raise ValueError()
 
-            if not nests.empty():
-                raise ValueError()
+                self.global_function['saved_registers'] = saved_registers
+                self.global_function['auto_save'] = auto_save
+                self.global_function['args_quantity'] = args_quantity
+                self.global_function['stack_args'] = stack_args
+                code = [
+                    f"label {parts[1]}",
+                    f"{FRAME_MARKER} enter",
+                ]
+                code.extend(f'push {register}' for register in saved_registers)
+                if auto_save:
+                    code.append(f"{SAVE_MARKER} def")
+                if args_quantity:
+                    code.append(f"sub sp {args_quantity} sp")
+                return code
+
+            case "ret":
+                if not self.global_function['is_inside']:
+                    raise ValueError()
 
-            if len(parts) == 1:
-                raise ValueError()
+                if not self.nests.empty():
+                    raise ValueError()
 
-            global_function['is_inside'] = True
+                if not len(parts) == 2:
+                    raise ValueError()
 
-            code = [
-                f"label {parts[1]}",
-                "push bp",
-                "mov sp bp",
-            ]
+                code = [f"mov {parts[1]} rv"]
+                if self.tail_calls and parts[1] == "rv":
+                    code.insert(0, RETURN_MARKER)
+                if self.global_function['args_quantity']:
+                    code.append(f"add sp {self.global_function['args_quantity']} sp")
+                if self.global_function['auto_save']:
+                    code.append(f"{RESTORE_MARKER} def")
+                for register in reversed(self.global_function['saved_registers']):
+                    code.append(f"pop {register}")
+                code.append(f"{FRAME_MARKER} leave")
+                code.append("pop pc")
+                if self.region is None:
+                    # Nothing resolves the markers without a region
+                    code = [line for line in code if not line.startswith('.')]
+
+                self.region_frame = dict(self.global_function)
+                self.region_closed = self.region is not None
+                self.global_function['is_inside'] = False
+                self.global_function['name'] = None
+                self.global_function['args_quantity'] = 0
+                self.global_function['stack_args'] = None
+                self.global_function['saved_registers'] = []
+                self.global_function['auto_save'] = False
+                self.global_function['uses_frame'] = False
+                self.global_function['free_sys_label'] = 0
+
+                return code
+
+            case "call":
+                if len(parts) == 1:
+                    raise ValueError()
 
-            mode = None
-            for tok in parts[2:]:
-                if tok in ("save", "reserve"):
-                    mode = tok
-                elif mode == "save":
-                    if tok in CALLEE_SAVED:
-                        global_function['saved_registers'].append(tok)
-                        code.append(f'push {tok}')
-                    else:
-                        raise ValueError()
-                elif mode == "reserve":
-                    if not global_function['args_quantity']:
-                        global_function['args_quantity'] = int(tok)
+                code = []
+                goto_dst = parts[1]
+                saved_registers = []
+                args = []
+                marker = None
+                mode = None
+                for tok in parts[2:]:
+                    if tok in ("save", "args"):
+                        mode = tok
+                    elif mode == "save":
+                        if tok == "auto":
+                            marker = str(self.free_save_marker)
+                            self.free_save_marker += 1
+                        elif tok in CALLER_SAVED:
+                            saved_registers.append(tok)
+                            code.append(f'push {tok}')
+                        else:
+                            raise ValueError()
+                    elif mode == "args":
+                        args.append(tok)
                     else:
                         raise ValueError()
+
+                if marker is not None:
+                    code.append(f"{SAVE_MARKER} {marker}")
+                    if self.region is None:
+                        self.region = []
+                inline = self.inline.get(goto_dst)
+                # A function inlined by size is still a function, a call with arguments calls it
+                inline = inline if inline is not None and not (inline['auto'] and args) else None
+                if inline is not None:
+                    body, written = self.expand_inline(goto_dst, args)
+                    code.extend(body)
+                    if marker is not None:
+                        self.save_masks[marker] = written
                 else:
+                    for arg in reversed(args):
+                        code.append(f'push {arg}')
+                    code.append("push pc+")
+                    code.append(f"jmp {goto_dst}")
+                    if args:
+                        code.append(f"add sp {len(args)} sp")
+                if marker is not None:
+                    code.append(f"{RESTORE_MARKER} {marker}")
+                for register in reversed(saved_registers):
+                    code.append(f"pop {register}")
+                if inline is None and self.tail_calls and self.global_function['is_inside'] and not self.inlining:
+                    call = str(len(self.calls))
+                    self.calls[call] = {'target': goto_dst, 'args': args}
+                    code.insert(0, f"{CALL_MARKER} {call}")
+                    code.append(f"{CALLED_MARKER} {call}")
+                return code
+
+            case "if":
+                if not len(parts) == 4:
                     raise ValueError()
 
-            if global_function['args_quantity']:
-                code.append(f"sub sp {global_function['args_quantity']} sp")
-            return code_to_str(code)
-
-        case "ret":
-            if not global_function['is_inside']:
-                raise ValueError()
-
-            if not nests.empty():
-                raise ValueError()
-
-            if not len(parts) == 2:
-                raise ValueError()
-
-            code = [f"mov {parts[1]} rv"]
-            if global_function['args_quantity']:
-                code.append(f"add sp {global_function['args_quantity']} sp")
-            for register in global_function['saved_registers']:
-                code.append(f"pop {register}")
-            code.append("pop bp")
-            code.append("pop pc")
-
-            global_function['is_inside'] = False
-            global_function['args_quantity'] = 0
-            global_function['saved_registers'] = []
-
-            return code_to_str(code)
-
-        case "call":
-            if len(parts) == 1:
-                raise ValueError()
-
-            code = []
-            goto_dst = parts[1]
-            saved_registers = []
-            args = []
-            mode = None
-            for tok in parts[2:]:
-                if tok in ("save", "args"):
-                    mode = tok
-                elif mode == "save":
-                    if tok in CALLER_SAVED:
-                        saved_registers.append(tok)
-                        code.append(f'push {tok}')
-                    else:
-                        raise ValueError()
-                elif mode == "args":
-                    args.append(tok)
-                else:
+                if not is_condition(*parts[1:]):
                     raise ValueError()
 
-            for arg in reversed(args):
-                code.append(f'push {arg}')
-            code.append("push pc+")
-            code.append(f"jmp {goto_dst}")
-            if args:
-                code.append(f"add sp {len(args)} sp")
-            for register in saved_registers:
-                code.append(f"pop {register}")
-            return code_to_str(code)
-
-        case "if":
-            if not len(parts) == 4:
-                raise ValueError()
-
-            if not is_condition(*parts[1:]):
-                raise ValueError()
-
-            sys_label = get_free_sys_label()
-            true_label = sys_label + "t"
-            false_label = sys_label + "f"
-            end_label = sys_label + "e"
-            nests.put({
-                'condition': 'if',
-                'label': sys_label,
-                'end_label': end_label,
-                'false_label': false_label,
-                'else': False,
-                'elif': 0,
-            })
-            condition, arg1, arg2 = parts[1:]
-            code = [
-                f"{condition} {arg1} {arg2} {true_label}",
-                f"jmp {false_label}",
-                f"label {true_label}",
-            ]
-            return code_to_str(code)
-
-        case "elif":
-            if not len(parts) == 4:
-                raise ValueError()
-
-            if not is_condition(*parts[1:]):
-                raise ValueError()
-
-            nested = nests.get()
-            if not nested['condition'] == "if":
-                raise ValueError()
-
-            label = nested['label']
-            index = nested['elif']
-            old_false_label = nested['false_label']
-            false_label = label + 'f' + str(index)
-            end_label = nested['end_label']
-            nested['elif'] = index + 1
-            nested['false_label'] = false_label
-            nests.put(nested)
-
-            true_label = label + 't' + str(index)
-            condition, arg1, arg2 = parts[1:]
-            code = [
-                f"jmp {end_label}",
-                f"label {old_false_label}",
-                f"{condition} {arg1} {arg2} {true_label}",
-                f"jmp {false_label}",
-                f"label {true_label}",
-            ]
-            return code_to_str(code)
+                sys_label = self.get_free_sys_label()
+                true_label = sys_label + "t"
+                false_label = sys_label + "f"
+                end_label = sys_label + "e"
+                self.nests.put({
+                    'condition': 'if',
+                    'label': sys_label,
+                    'end_label': end_label,
+                    'false_label': false_label,
+                    'else': False,
+                    'elif': 0,
+                })
+                condition, arg1, arg2 = parts[1:]
+                code = [
+                    f"{condition} {arg1} {arg2} {true_label}",
+                    f"jmp {false_label}",
+                    f"label {true_label}",
+                ]
+                return code
 
-        case "else":
-            if nests.empty():
-                raise ValueError()
+            case "elif":
+                if not len(parts) == 4:
+                    raise ValueError()
 
-            if not len(parts) == 1:
-                raise ValueError()
+                if not is_condition(*parts[1:]):
+                    raise ValueError()
+
+                # get() on an empty queue would wait for a put forever
+                if self.nests.empty() or not self.nests.queue[-1]['condition'] == "if":
+                    raise ValueError("elif without if")
 
-            nested = nests.get()
-            if nested['condition'] == "if":
+                nested = self.nests.get()
+                label = nested['label']
+                index = nested['elif']
+                old_false_label = nested['false_label']
+                false_label = label + 'f' + str(index)
                 end_label = nested['end_label']
-                false_label = nested['false_label']
-                nested['else'] = True
-                nests.put(nested)
+                nested['elif'] = index + 1
+                nested['false_label'] = false_label
+                self.nests.put(nested)
+
+                true_label = label + 't' + str(index)
+                condition, arg1, arg2 = parts[1:]
                 code = [
                     f"jmp {end_label}",
-                    f"label {false_label}",
+                    f"label {old_false_label}",
+                    f"{condition} {arg1} {arg2} {true_label}",
+                    f"jmp {false_label}",
+                    f"label {true_label}",
                 ]
-                return code_to_str(code)
+                return code
 
-            else:
-                nests.put(nested)
-                raise ValueError()
-        case "for":
-            if len(parts) < 4 or len(parts) > 5:
-                raise ValueError()
-
-            dst = parts[1]
-            start = parts[2]
-            stop = parts[3]
-            step = 1
-            if len(parts) == 5:
-                step = parts[4]
-
-            label = get_free_sys_label()
-            start_label = label + 's'
-            true_label = label + 't'
-            end_label = label + 'e'
-            nests.put({
-                'condition': 'for',
-                'dst': dst,
-                'start': start,
-                'stop': stop,
-                'step': step,
-                'label': label,
-                'start_label': start_label,
-                'end_label': end_label,
-            })
-            code = [
-                f"mov {start} {dst}",
-                f"label {start_label}",
-                f"lt {dst} {stop} {true_label}",
-                f"jmp {end_label}",
-                f"label {true_label}",
-            ]
-            return code_to_str(code)
-
-        case "while":
-            if not len(parts) == 4:
-                raise ValueError()
-
-            if not is_condition(*parts[1:]):
-                raise ValueError()
-
-            sys_label = get_free_sys_label()
-            true_label = sys_label + "t"
-            false_label = sys_label + "f"
-            start_label = sys_label + "s"
-            nests.put({
-                'condition': 'while',
-                'label': sys_label,
-                'start_label': start_label,
-                'false_label': false_label,
-            })
-            condition, arg1, arg2 = parts[1:]
-            code = [
-                f"label {start_label}",
-                f"{condition} {arg1} {arg2} {true_label}",
-                f"jmp {false_label}",
-                f"label {true_label}",
-            ]
-            return code_to_str(code)
-
-        case "end":
-            if nests.empty():
-                raise ValueError()
+            case "else":
+                if self.nests.empty():
+                    raise ValueError()
 
-            if not len(parts) == 1:
-                raise ValueError()
+                if not len(parts) == 1:
+                    raise ValueError()
 
-            nested = nests.get()
-            match nested['condition']:
-                case "if":
-                    if nested['else'] or nested['elif']:
-                        end_label = nested['end_label']
-                    else:
-                        end_label = nested['false_label']
-                    code = [f"label {end_label}"]
-                    return code_to_str(code)
-                case "while":
+                nested = self.nests.get()
+                if nested['condition'] == "if" and not nested['else']:
+                    end_label = nested['end_label']
+                    false_label = nested['false_label']
+                    nested['else'] = True
+                    self.nests.put(nested)
                     code = [
-                        f"jmp {nested['start_label']}",
-                        f"label {nested['false_label']}",
+                        f"jmp {end_label}",
+                        f"label {false_label}",
                     ]
-                    return code_to_str(code)
-                case "for":
-                    code = [
-                        f"add {nested['dst']} {nested['step']} {nested['dst']}",
-                        f"jmp {nested['start_label']}",
-                        f"label {nested['end_label']}"
+                    return code
+
+                else:
+                    self.nests.put(nested)
+                    raise ValueError()
+            case "for":
+                if len(parts) < 4 or len(parts) > 5:
+                    raise ValueError()
+
+                dst = parts[1]
+                start = parts[2]
+                stop = parts[3]
+                step = 1
+                if len(parts) == 5:
+                    step = parts[4]
+
+                label = self.get_free_sys_label()
+                start_label = label + 's'
+                true_label = label + 't'
+                end_label = label + 'e'
+                self.nests.put({
+                    'condition': 'for',
+                    'dst': dst,
+                    'start': start,
+                    'stop': stop,
+                    'step': step,
+                    'label': label,
+                    'start_label': start_label,
+                    'true_label': true_label,
+                    'end_label': end_label,
+                })
+                if self.rotate_loops:
+                    return [
+                        f"mov {start} {dst}",
+                        f"gte {dst} {stop} {end_label}",
+                        f"label {true_label}",
                     ]
-                    return code_to_str(code)
-                case _:
+                code = [
+                    f"mov {start} {dst}",
+                    f"label {start_label}",
+                    f"lt {dst} {stop} {true_label}",
+                    f"jmp {end_label}",
+                    f"label {true_label}",
+                ]
+                return code
+
+            case "while":
+                if not len(parts) == 4:
                     raise ValueError()
 
-        case _:
-            return line
+                if not is_condition(*parts[1:]):
+                    raise ValueError()
 
+                sys_label = self.get_free_sys_label()
+                true_label = sys_label + "t"
+                false_label = sys_label + "f"
+                start_label = sys_label + "s"
+                condition, arg1, arg2 = parts[1:]
+                self.nests.put({
+                    'condition': 'while',
+                    'label': sys_label,
+                    'start_label': start_label,
+                    'true_label': true_label,
+                    'false_label': false_label,
+                    'test': f"{condition} {arg1} {arg2} {true_label}",
+                })
+                if self.rotate_loops:
+                    if condition in INVERSE_CONDITIONS:
+                        guard = f"{INVERSE_CONDITIONS[condition]} {arg1} {arg2} {false_label}"
+                    else:
+                        guard = f"jmp {start_label}"
+                    return [
+                        guard,
+                        f"label {true_label}",
+                    ]
+                code = [
+                    f"label {start_label}",
+                    f"{condition} {arg1} {arg2} {true_label}",
+                    f"jmp {false_label}",
+                    f"label {true_label}",
+                ]
+                return code
 
-def unpack_macro_commands(in_path: str, out_path: str) -> list:
-    with open(in_path, 'r', encoding='utf-8') as fin, \
-            open(out_path, 'w', encoding='utf-8') as fout:
-        messages = []
-        for ln, line in enumerate(fin, 1):
+            case "switch":
+                if not len(parts) == 2:
+                    raise ValueError()
+
+                if not is_register(parts[1]) or parts[1] in PC_REGISTERS:
+                    raise ValueError()
+
+                label = self.get_free_sys_label()
+                self.nests.put({
+                    'condition': 'switch',
+                    'register': parts[1],
+                    'label': label,
+                    'dispatch_label': label + 's',
+                    'end_label': label + 'e',
+                    'default_label': None,
+                    'cases': {},
+                    'sections': 0,
+                })
+                # The bodies come first, the dispatch is only known at 'end'
+                return [f"jmp {label}s"]
+
+            case "case" | "default":
+                if self.nests.empty():
+                    raise ValueError()
+
+                nested = self.nests.queue[-1]
+                if not nested['condition'] == "switch":
+                    raise ValueError()
+
+                if op == "default":
+                    if not len(parts) == 1 or nested['default_label'] is not None:
+                        raise ValueError()
+                    label = nested['label'] + 'd'
+                    nested['default_label'] = label
+                else:
+                    if len(parts) == 1:
+                        raise ValueError()
+                    label = nested['label'] + 'c' + str(nested['sections'])
+                    for tok in parts[1:]:
+                        value = number(tok)
+                        if value is None:
+                            raise ValueError(f"case value {tok!r} is not a number")
+                        if to_u16(value) in nested['cases']:
+                            raise ValueError(f"case {tok} is already handled")
+                        nested['cases'][to_u16(value)] = label
+                # No fallthrough: the previous section ends at the end of the switch
+                code = [f"jmp {nested['end_label']}"] if nested['sections'] else []
+                nested['sections'] += 1
+                code.append(f"label {label}")
+                return code
+
+            case "end":
+                if self.nests.empty():
+                    raise ValueError()
+
+                if not len(parts) == 1:
+                    raise ValueError()
+
+                nested = self.nests.get()
+                match nested['condition']:
+                    case "if":
+                        if nested['else']:
+                            end_label = nested['end_label']
+                        elif nested['elif']:
+                            # The last elif jumps to its false label when it does not hold
+                            return [
+                                f"label {nested['false_label']}",
+                                f"label {nested['end_label']}",
+                            ]
+                        else:
+                            end_label = nested['false_label']
+                        code = [f"label {end_label}"]
+                        return code
+                    case "while" if self.rotate_loops:
+                        return [
+                            f"label {nested['start_label']}",
+                            nested['test'],
+                            f"label {nested['false_label']}",
+                        ]
+                    case "for" if self.rotate_loops:
+                        return [
+                            f"add {nested['dst']} {nested['step']} {nested['dst']}",
+                            f"lt {nested['dst']} {nested['stop']} {nested['true_label']}",
+                            f"label {nested['end_label']}",
+                        ]
+                    case "while":
+                        code = [
+                            f"jmp {nested['start_label']}",
+                            f"label {nested['false_label']}",
+                        ]
+                        return code
+                    case "for":
+                        code = [
+                            f"add {nested['dst']} {nested['step']} {nested['dst']}",
+                            f"jmp {nested['start_label']}",
+                            f"label {nested['end_label']}"
+                        ]
+                        return code
+                    case "switch":
+                        code = [f"jmp {nested['end_label']}"] if nested['sections'] else []
+                        code.append(f"label {nested['dispatch_label']}")
+                        code.extend(self.switch_dispatch(nested))
+                        code.append(f"label {nested['end_label']}")
+                        return code
+                    case _:
+                        raise ValueError()
+
+            case _:
+                return [line]
+
+    @staticmethod
+    def switch_dispatch(switch: dict) -> list[str]:
+        """
+        Code that jumps to the section of the switch value, or to its default.
+        Dense values go through a table of jumps indexed by 'add reg pc pc':
+        from 0 if that keeps the table dense, else from the smallest value,
+        which is subtracted and added back on the way to the section.
+        Sparse values are found by a balanced binary search.
+        """
+        register = switch['register']
+        label = switch['label']
+        default = switch['default_label'] or switch['end_label']
+        values = sorted(switch['cases'])
+        if not values:
+            return [f"jmp {default}"]
+
+        low, high = values[0], values[-1]
+        if len(values) < SWITCH_TABLE_MIN or high - low + 1 > SWITCH_DENSITY * len(values):
+            return _switch_search(register, [(value, switch['cases'][value]) for value in values],
+                                  default, label + 'b')
+
+        if high + 1 <= SWITCH_DENSITY * len(values):
+            # Unsigned: the check also sends values below the smallest case to default
+            return [f"gt {register} {high} {default}", f"add {register} pc pc"] + [
+                f"jmp {switch['cases'].get(value, default)}" for value in range(high + 1)
+            ]
+
+        restore = {target: label + 'r' + target[len(label):] for target in switch['cases'].values()}
+        restore[default] = label + 'r'
+        code = [
+            f"sub {register} {low} {register}",
+            f"gt {register} {high - low} {label}r",
+            f"add {register} pc pc",
+        ]
+        code.extend(f"jmp {restore[switch['cases'].get(value, default)]}" for value in range(low, high + 1))
+        for target, stub in restore.items():
+            code.extend([f"label {stub}", f"add {register} {low} {register}", f"jmp {target}"])
+        return code
+
+    def unpack_macro_lines(self, lines, messages: list, finish: bool = True):
+        """
+        Expand macros of (line_number, code) pairs produced by clean_lines.
+        Yields (line_number, code) pairs of base instructions, keeping the source
+        line number of the macro each instruction came from.
+        With finish=False more lines may follow, so open blocks are not reported.
+        """
+        for ln, line in lines:
+            parts = tokenize(line)
+            # Inline functions were collected beforehand and expand at their calls
+            if self.skipping_inline or parts[0] == "inline":
+                self.skipping_inline = parts[0] != "ret"
+                continue
+            # Top-level code can fall through into a function, a region ends before it
+            if self.region is not None and self.region_function is None and parts[0] == "def":
+                yield from self.close_region()
+            if parts[0] in MACROS:
+                nest_label = None if self.nests.empty() else self.nests.queue[-1]['label']
+                function = self.global_function['name']
             try:
-                out_line = process_line(line)
+                code = self.process_line(line)
             except ValueError as e:
-                messages.append('')
+                messages.append(f"Error while unpack macro: {ln}: {str(e) or repr(line)}")
             else:
-                fout.write(out_line)
-
-        if global_function['is_inside']:
-            messages.append('')
+                if parts[0] in MACROS:
+                    self.macros[ln] = (parts[0], self.macro_label(parts, nest_label, function))
+                if self.region is None:
+                    for out_line in code:
+                        yield ln, out_line
+                else:
+                    self.region.extend((ln, out_line) for out_line in code)
+                    if self.region_closed:
+                        yield from self.close_region()
+
+        if self.region is not None and (finish or self.region_function is None):
+            yield from self.close_region()
+
+        if finish:
+            self.check_finished(messages)
+
+    def macro_label(self, parts: list, nest_label: str | None, function: str | None) -> str | None:
+        """The system label of a processed block macro, or the function a def, ret or call names."""
+        match parts[0]:
+            case "def" | "call":
+                return parts[1]
+            case "ret":
+                return function
+            case "end":
+                return nest_label
+            case _:
+                return self.nests.queue[-1]['label']
+
+    def close_region(self):
+        """
+        Decide the automatic saves and the frame of the held back region and
+        yield it. A call saves the caller-saved registers live after it
+        returns, a function the callee-saved registers its body writes.
+        """
+        region, function, frame = self.region, self.region_function, self.region_frame
+        self.region = None
+        self.region_function = None
+        self.region_frame = None
+        self.region_closed = False
+        if frame is not None and self.calls:
+            region = self.replace_tail_calls(region, frame)
+        self.calls = {}
+        explicit = frame['saved_registers'] if frame is not None else []
+        # A function without ret keeps its frame, it is reported anyway
+        keep_frame = frame is None or not self.omit_frame_pointer or frame['uses_frame'] \
+            or bool(frame['args_quantity'])
+
+        code = [line for _, line in region]
+        live = liveness.analyze(code, self.summaries)
+        saves = {}
+        for i, line in enumerate(code):
+            parts = tokenize(line)
+            if parts[0] == RESTORE_MARKER:
+                written = self.save_masks.get(parts[1], liveness.ALL)
+                saves[parts[1]] = liveness.registers(live[i] & liveness.mask(CALLER_SAVED) & written)
+        self.save_masks = {}
+        if function is not None:
+            written = liveness.written(code) & liveness.mask(CALLEE_SAVED) & ~liveness.mask(explicit)
+            saves['def'] = liveness.registers(written)
+            self.summaries[function] = live[0]
+
+        for ln, line in region:
+            parts = tokenize(line)
+            if parts[0] == SAVE_MARKER:
+                for register in saves.get(parts[1], ()):
+                    yield ln, f"push {register}"
+            elif parts[0] == RESTORE_MARKER:
+                for register in reversed(saves.get(parts[1], ())):
+                    yield ln, f"pop {register}"
+            elif parts[0] == FRAME_MARKER:
+                if keep_frame:
+                    for frame_line in FRAME_CODE[parts[1]]:
+                        yield ln, frame_line
+            elif parts[0] not in (CALL_MARKER, CALLED_MARKER, RETURN_MARKER):
+                yield ln, line
+
+    def replace_tail_calls(self, region: list, frame: dict) -> list:
+        """
+        Replace every call of a function region after which control reaches
+        'ret rv' through labels and jumps only by the epilogue and a jump to
+        the callee. A 'ret rv' that only a tail call fell into is dropped.
+        """
+        code = [tokenize(line) for _, line in region]
+        positions = {parts[1]: i for i, parts in enumerate(code) if parts[0] == 'label'}
+        starts = {parts[1]: i for i, parts in enumerate(code) if parts[0] == CALL_MARKER}
+
+        def reaches_return(i):
+            seen = set()
+            while i < len(code) and i not in seen:
+                seen.add(i)
+                parts = code[i]
+                if parts[0] == RETURN_MARKER:
+                    return i
+                if parts[0] in ('label', CALL_MARKER, CALLED_MARKER, SAVE_MARKER, RESTORE_MARKER):
+                    i += 1
+                elif parts[0] == 'jmp' and parts[1] in positions:
+                    i = positions[parts[1]]
+                else:
+                    return None
+            return None
+
+        result = []
+        i = 0
+        while i < len(code):
+            parts = code[i]
+            if parts[0] != CALLED_MARKER:
+                result.append(region[i])
+                i += 1
+                continue
+            ret = reaches_return(i + 1)
+            tail = None if ret is None else self.tail_call(self.calls[parts[1]], frame)
+            if tail is None:
+                result.append(region[i])
+                i += 1
+                continue
+
+            start = starts[parts[1]]
+            ln = region[start][0]
+            del result[len(result) - (i - start):]
+            # The epilogue without 'mov rv rv' and 'pop pc'
+            end = ret
+            while code[end] != ('pop', 'pc'):
+                end += 1
+            result.extend((ln, line) for _, line in region[ret + 2:end])
+            result.extend((ln, line) for line in tail)
+            i += 1
+            if ret == i:
+                i = end + 1
+        return result
+
+    def collect_inline(self, lines, messages: list, threshold: int = 0):
+        """
+        Record every 'inline def NAME [params P...] [save R...]' ... 'ret X' of
+        (line_number, code) pairs in inline, before any of them is expanded, so
+        calls may come first. With threshold, every plain def whose body has at
+        most threshold lines, takes no arguments, reserves no locals, saves
+        nothing automatically and neither calls nor names bp or sp is recorded
+        too; it stays a function for calls with arguments.
+        """
+        function = None
+        for ln, line in lines:
+            parts = tokenize(line)
+            try:
+                if function is None:
+                    if parts[0] == "inline":
+                        function = self.inline_header(parts[1:], ln)
+                    elif threshold and parts[0] == "def":
+                        function = self.inline_header(parts, ln, auto=True)
+                    continue
+                if parts[0] in ("def", "inline"):
+                    function = None
+                    if parts[0] == "inline":
+                        raise ValueError("inline def inside a function")
+                    continue
+                if parts[0] == "ret":
+                    if len(parts) != 2 or function['depth']:
+                        if function['auto']:
+                            function = None
+                            continue
+                        raise ValueError("ret of an inline function must close all blocks and return a value")
+                    function['value'] = parts[1]
+                    if not function['auto'] or function['inlinable'] and len(function['body']) <= threshold:
+                        if function['name'] in self.inline:
+                            raise ValueError(f"inline function {function['name']} is defined twice")
+                        self.inline[function['name']] = function
+                    function = None
+                    continue
+                if parts[0] in BLOCK_MACROS:
+                    function['depth'] += 1
+                elif parts[0] == "end":
+                    function['depth'] -= 1
+                unsafe = not FRAME_REGISTERS.isdisjoint(parts) or parts[0] in DATA_DIRECTIVES
+                if function['auto']:
+                    function['inlinable'] = function['inlinable'] and not unsafe and parts[0] != "call"
+                elif unsafe:
+                    raise ValueError(f"inline function {function['name']} can not use bp, sp or data")
+                if parts[0] == "label" and len(parts) == 2:
+                    function['labels'].append(parts[1])
+                function['body'].append(line)
+            except ValueError as e:
+                messages.append(f"Error while unpack macro: {ln}: {e}")
+                function = None
+        if function is not None and not function['auto']:
+            messages.append(f"Error while unpack macro: {function['line']}: inline def {function['name']} has no ret")
+
+    @staticmethod
+    def inline_header(parts: tuple, ln: int, auto: bool = False) -> dict | None:
+        """The record of an inline function from its 'def' line, None if a def can not be inlined."""
+        if len(parts) < 2 or parts[0] != "def":
+            if auto:
+                return None
+            raise ValueError("expected 'inline def NAME [params P...] [save R...]'")
+        function = {
+            'name': parts[1], 'params': [], 'saves': [], 'body': [], 'labels': [], 'value': None,
+            'auto': auto, 'inlinable': True, 'depth': 0, 'line': ln,
+        }
+        mode = None
+        for tok in parts[2:]:
+            if tok in ("params", "save", "reserve", "args"):
+                mode = tok
+            elif mode == "save" and tok in CALLEE_SAVED:
+                function['saves'].append(tok)
+            elif mode == "params" and not auto and not is_register(tok) and tok not in function['params']:
+                function['params'].append(tok)
+            elif auto:
+                # Stack arguments, locals and automatic saves need a real frame
+                return None
+            else:
+                raise ValueError(f"unexpected {tok!r} in inline def {parts[1]}")
+        return function
+
+    def expand_inline(self, name: str, args: list) -> tuple[list[str], int]:
+        """
+        The body of inline function name for one call, with its parameters
+        replaced by args, its labels by fresh system labels, its macros
+        expanded and 'ret X' turned into 'mov X rv'. Also returns the
+        registers the body writes as a liveness mask.
+        """
+        function = self.inline[name]
+        if len(args) != len(function['params']):
+            raise ValueError(f"inline function {name} expects {len(function['params'])} arguments, got {len(args)}")
+        if name in self.inlining:
+            raise ValueError(f"inline function {name} calls itself")
+        names = dict(zip(function['params'], args))
+        for label in function['labels']:
+            names[label] = self.get_free_sys_label() + "l"
+
+        self.inlining.append(name)
+        try:
+            body = []
+            for line in function['body']:
+                body.extend(self.process_line(' '.join(names.get(tok, tok) for tok in tokenize(line))))
+        finally:
+            self.inlining.pop()
+
+        written = liveness.written(body)
+        if "push pc+" in body:
+            # A call in the body may write any register a callee may
+            written |= liveness.mask(CALLER_SAVED + ['rv'])
+        for arg in args:
+            if written & liveness.mask([arg]):
+                raise ValueError(f"inline function {name} writes {arg}, pass the argument in another register")
+        value = names.get(function['value'], function['value'])
+        code = [f"push {register}" for register in function['saves']] + body
+        if value != "rv":
+            code.append(f"mov {value} rv")
+            written |= liveness.BIT['rv']
+        code.extend(f"pop {register}" for register in reversed(function['saves']))
+
+        # What a call would have cost: argument pushes, 'push pc+', 'jmp',
+        # 'add sp', 'pop pc' and the frame unless it is omitted
+        overhead = len(args) + 3 + bool(args) + (0 if self.omit_frame_pointer else 3)
+        stats = self.inlined.setdefault(name, [0, 0])
+        stats[0] += 1
+        stats[1] += overhead
+        return code, written & ~liveness.mask(function['saves'])
+
+    def check_finished(self, messages: list):
+        if self.global_function['is_inside']:
+            messages.append("Error while unpack macro: function is not closed with ret")
+
+        if not self.nests.empty():
+            messages.append("Error while unpack macro: block is not closed with end")
+
+
+def _switch_search(register: str, cases: list, default: str, label: str) -> list[str]:
+    """
+    Binary search of sorted (value, target) pairs: an 'lt' per level halves
+    them, the last SWITCH_LINEAR or fewer are compared with 'eq'.
+    """
+    if len(cases) <= SWITCH_LINEAR:
+        return [f"eq {register} {value} {target}" for value, target in cases] + [f"jmp {default}"]
+    middle = len(cases) // 2
+    return [f"lt {register} {cases[middle][0]} {label}"] \
+        + _switch_search(register, cases[middle:], default, label + 'h') \
+        + [f"label {label}"] \
+        + _switch_search(register, cases[:middle], default, label + 'l')
+
+
+def split_functions(lines) -> list[tuple[str | None, list]]:
+    """
+    Group (line_number, code) pairs into blocks. Every 'def name ...' up to its
+    'ret' becomes (name, pairs); the code around functions becomes (None, pairs).
+    A def without ret is left in the surrounding code block.
+    """
+    blocks = []
+    current = []
+    function = None
+    for ln, line in lines:
+        parts = tokenize(line)
+        if function is None and parts[0] == "def" and len(parts) > 1:
+            if current:
+                blocks.append((None, current))
+            function, current = parts[1], []
+        current.append((ln, line))
+        if function is not None and parts[0] == "ret":
+            blocks.append((function, current))
+            function, current = None, []
+    if current:
+        blocks.append((None, current))
+    return blocks
 
-        if not nests.empty():
-            messages.append('')
 
+def unpack_macro_commands(in_path: str, out_path: str) -> list:
+    with open(in_path, 'r', encoding='utf-8') as fin, \
+            open(out_path, 'w', encoding='utf-8') as fout:
+        messages = []
+        lines = ((ln, line.strip()) for ln, line in enumerate(fin, 1))
+        for _, out_line in MacroExpander().unpack_macro_lines(lines, messages):
+            fout.write(out_line + "\n")
         return messages
@@ -1,5 +1,13 @@
 CONDITION_CODES = {'eq', 'lt', 'lte', 'gt', 'gte', 'lts', 'ltes', 'gts', 'gtes'}
 
+# Conditions whose negation is also a condition code. 'eq' has no 'ne'.
+INVERSE_CONDITIONS = {
+    'lt': 'gte', 'gte': 'lt',
+    'lte': 'gt', 'gt': 'lte',
+    'lts': 'gtes', 'gtes': 'lts',
+    'ltes': 'gts', 'gts': 'ltes',
+}
+
 REGISTERS = {
     'r0': 0,
     'r1': 1,
@@ -17,11 +25,9 @@ REGISTERS = {
 
 
 def is_int(tok: str) -> bool:
-    try:
-        int(tok)
-        return True
-    except ValueError:
-        return False
+    # lexer imports this module for REGISTERS
+    from lexer import number
+    return number(tok) is not None
 
 
 def is_register(tok: str) -> bool:
@@ -0,0 +1,208 @@
+import argparse
+import json
+import math
+import os
+import socket
+import socketserver
+import statistics
+import sys
+import threading
+import time
+
+from batch import add_build_options, build_one, build_options
+from cache import BuildCache
+
+
+class BuildServer:
+    """
+    Rebuilds sources in one long-running process. Every source keeps an
+    in-memory BuildCache between builds, so an unchanged function is taken
+    with its encoded words, labels and fixups from the previous build and
+    only the changed functions and the code around them are assembled again.
+    The lexer keeps its tokens warm for the same reason.
+    Builds are serialized, so requests may come from several threads.
+    """
+
+    def __init__(self, out_dir: str | None = None, output_format: str = 'text',
+                 options: dict | None = None, source_map: bool = False):
+        self.out_dir = out_dir
+        self.output_format = output_format
+        self.options = options or {}
+        self.source_map = source_map
+        self.caches = {}
+        self.stamps = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def build(self, source: str, profile: bool = False) -> dict:
+        """Build source now; the result of batch.build_one with the latency and the reused functions."""
+        with self.lock:
+            cache = self.caches.get(source)
+            if cache is None:
+                cache = self.caches[source] = BuildCache()
+            hits, misses = cache.hits, cache.misses
+            started = time.perf_counter()
+            result = build_one(source, self.out_dir, self.output_format, options=self.options,
+                               source_map=self.source_map, profile=profile, cache=cache)
+            milliseconds = (time.perf_counter() - started) * 1000
+            cache.prune()
+            self.latencies.append(milliseconds)
+        result['milliseconds'] = milliseconds
+        result['reused'] = cache.hits - hits
+        result['rebuilt'] = cache.misses - misses
+        return result
+
+    def changed(self, sources: list[str]) -> list[str]:
+        """Sources whose modification time or size differs from the last call."""
+        result = []
+        for source in sources:
+            try:
+                info = os.stat(source)
+            except OSError:
+                continue
+            stamp = (info.st_mtime_ns, info.st_size)
+            if self.stamps.get(source) != stamp:
+                self.stamps[source] = stamp
+                result.append(source)
+        return result
+
+    def watch(self, sources: list[str], interval: float = 0.05, stop: threading.Event | None = None,
+              on_result=None):
+        """Poll sources every interval seconds and rebuild the changed ones until stop is set."""
+        stop = stop or threading.Event()
+        on_result = on_result or (lambda result: print(format_result(result), flush=True))
+        while not stop.is_set():
+            for source in self.changed(sources):
+                on_result(self.build(source))
+            stop.wait(interval)
+
+    def handle(self, request: str) -> dict | None:
+        """
+        Answer one request line: 'build PATH', 'stats' or 'quit'.
+        Returns the reply, or None for quit.
+        """
+        parts = request.split(maxsplit=1)
+        if not parts:
+            return {'errors': ["empty request"]}
+        match parts[0]:
+            case "build" if len(parts) == 2:
+                return self.build(parts[1])
+            case "stats":
+                return self.stats()
+            case "quit":
+                return None
+        return {'errors': [f"unknown request {request!r}, expect 'build PATH', 'stats' or 'quit'"]}
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'builds': 0}
+        return {
+            'builds': len(latencies),
+            'min_ms': latencies[0],
+            'median_ms': statistics.median(latencies),
+            'p95_ms': latencies[math.ceil(0.95 * len(latencies)) - 1],
+            'max_ms': latencies[-1],
+        }
+
+
+def format_result(result: dict) -> str:
+    if result['errors']:
+        return f"FAIL {result['source']} in {result['milliseconds']:.1f} ms\n" \
+            + '\n'.join(f"    {message}" for message in result['errors'])
+    return (f"ok   {result['source']} -> {result['output']} ({result['instructions']} instructions) "
+            f"in {result['milliseconds']:.1f} ms, {result['reused']} functions reused, "
+            f"{result['rebuilt']} rebuilt")
+
+
+def format_stats(stats: dict) -> str:
+    if not stats['builds']:
+        return "no builds"
+    return (f"{stats['builds']} builds: min {stats['min_ms']:.1f} ms, median {stats['median_ms']:.1f} ms, "
+            f"p95 {stats['p95_ms']:.1f} ms, max {stats['max_ms']:.1f} ms")
+
+
+def serve_lines(server: BuildServer, fin, fout, stop: threading.Event):
+    """Answer request lines from fin with one JSON line each until quit or end of input."""
+    for line in fin:
+        if not line.strip():
+            continue
+        reply = server.handle(line.strip())
+        if reply is None:
+            stop.set()
+            return
+        fout.write(json.dumps(reply) + '\n')
+        fout.flush()
+
+
+def serve_socket(server: BuildServer, path: str, stop: threading.Event) -> socketserver.BaseServer:
+    """Serve the request protocol of serve_lines on a Unix socket at path, in a background thread."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            reader = (line.decode('utf-8') for line in self.rfile)
+            writer = _SocketWriter(self.wfile)
+            serve_lines(server, reader, writer, stop)
+
+    if os.path.exists(path):
+        os.remove(path)
+    unix_server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    unix_server.daemon_threads = True
+    threading.Thread(target=unix_server.serve_forever, daemon=True).start()
+    return unix_server
+
+
+class _SocketWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text: str):
+        self.wfile.write(text.encode('utf-8'))
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild sources as they change, keeping the build state in memory.")
+    parser.add_argument('sources', nargs='*', help="source files to watch")
+    parser.add_argument('-o', '--out-dir', help="directory for outputs (default: next to each source)")
+    parser.add_argument('-f', '--format', choices=('text', 'bin'), default='text')
+    parser.add_argument('--source-map', action='store_true', help="write <output>.map.json next to every output")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between checks of the sources")
+    parser.add_argument('--stdin', action='store_true', help="answer 'build PATH', 'stats' and 'quit' on stdin")
+    parser.add_argument('--socket', metavar='PATH', help="answer the same requests on a Unix socket")
+    add_build_options(parser)
+    args = parser.parse_args(argv)
+
+    if not args.sources and not args.stdin and args.socket is None:
+        parser.error("nothing to do: give sources to watch, --stdin or --socket")
+    if args.socket is not None and not hasattr(socket, 'AF_UNIX'):
+        parser.error("Unix sockets are not available on this platform")
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    server = BuildServer(args.out_dir, args.format, build_options(args), args.source_map)
+    stop = threading.Event()
+    unix_server = serve_socket(server, args.socket, stop) if args.socket is not None else None
+    if args.stdin:
+        threading.Thread(target=serve_lines, args=(server, sys.stdin, sys.stdout, stop), daemon=True).start()
+
+    # With requests on stdout, build results of watched files go to stderr
+    output = sys.stderr if args.stdin else sys.stdout
+    try:
+        server.watch(args.sources, args.interval, stop,
+                     lambda result: print(format_result(result), file=output, flush=True))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if unix_server is not None:
+            unix_server.shutdown()
+            unix_server.server_close()
+            os.remove(args.socket)
+    print(format_stats(server.stats()), file=output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())